@@ -0,0 +1,172 @@
+import asyncio, datetime, threading, queue
+import pandas as pd
+import aiohttp
+
+from everest import scrape
+
+def put_until_stopped(out_queue,item,stopped=None,timeout=0.5):
+    # out_queue.put that gives up once stopped is set, so a producer can't be
+    # left blocked on a full queue whose consumer has failed
+    while stopped is None or not stopped.is_set():
+        try:
+            out_queue.put(item,timeout=timeout)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+class AsyncScraper:
+    # Owns an event loop running in a background thread, so it can be driven
+    # from plain synchronous code and from inside a running notebook loop.
+    # The session (and its connection pool) lives for as long as the scraper,
+    # so keep-alive connections are reused between scrape batches.
+    def __init__(self,time_limit=2,concurrency=100,per_host=2,keepalive=30,resolver=None,race=False):
+        self.time_limit = time_limit
+        self.race = race
+        self.concurrency = concurrency
+        self.per_host = per_host
+        self.keepalive = keepalive
+        self.resolver = resolver
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever,daemon=True)
+        self.thread.start()
+        self.run(self.open_session())
+
+    def run(self,coro):
+        return asyncio.run_coroutine_threadsafe(coro,self.loop).result()
+
+    async def open_session(self):
+        connector = aiohttp.TCPConnector(
+            limit=self.concurrency,
+            limit_per_host=self.per_host,
+            keepalive_timeout=self.keepalive,
+            resolver=self.resolver
+        )
+        # requests applies its timeout to connecting and to each read separately
+        timeout = aiohttp.ClientTimeout(
+            total=None,
+            sock_connect=self.time_limit,
+            sock_read=self.time_limit
+        )
+        self.session = aiohttp.ClientSession(connector=connector,timeout=timeout)
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+
+    async def fetch_url(self,url):
+        async with self.session.get(url) as r:
+            content = await r.read()
+            return r.status, content
+
+    async def fetch_domain(self,row):
+        # Same bookkeeping as scrape.scrape_domain: tries urls in order and
+        # stops at the first 200, returning the content of the last response
+        # alongside the updated row. With race=True every variant after the
+        # remembered one is requested at once and the first 200 wins.
+        urls_to_try = scrape.get_urls_to_try(row)
+        status, content, dtime = None, None, None
+        async with self.semaphore:
+            if self.race and len(urls_to_try) > 1:
+                first = urls_to_try[:1] if urls_to_try[0] == row.get('last_scrape_url') else []
+                for url in first:
+                    status, content, dtime = await self.fetch_row_url(row,url)
+                if status != 200:
+                    status, content, dtime = await self.race_urls(row,urls_to_try[len(first):])
+            else:
+                for url in urls_to_try:
+                    status, content, dtime = await self.fetch_row_url(row,url)
+                    if status == 200:
+                        break
+        return row, status, content, dtime
+
+    async def fetch_row_url(self,row,url):
+        dtime = datetime.datetime.now()
+        row['last_scrape_date'] = dtime
+        try:
+            status, content = await self.fetch_url(url)
+            row['last_scrape_request_error'] = None
+            row['last_scrape_code'] = status
+            if status == 200:
+                row['last_scrape_url'] = url
+            return status, content, dtime
+        except Exception as e:
+            row['last_scrape_code'] = None
+            row['last_scrape_request_error'] = str(e) or repr(e)
+            return None, None, dtime
+
+    async def race_urls(self,row,urls):
+        dtime = datetime.datetime.now()
+        row['last_scrape_date'] = dtime
+        tasks = {asyncio.ensure_future(self.fetch_url(url)): url for url in urls}
+        pending = set(tasks)
+        status, content = None, None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending,return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    try:
+                        status, content = task.result()
+                        row['last_scrape_request_error'] = None
+                        row['last_scrape_code'] = status
+                        if status == 200:
+                            row['last_scrape_url'] = tasks[task]
+                            return status, content, dtime
+                    except Exception as e:
+                        status, content = None, None
+                        row['last_scrape_code'] = None
+                        row['last_scrape_request_error'] = str(e) or repr(e)
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+                elif not task.cancelled():
+                    task.exception()
+        return status, content, dtime
+
+    async def scrape_domain(self,row,all_ahrefs_domains):
+        row, status, content, dtime = await self.fetch_domain(row)
+        if status == 200:
+            # parsing is CPU-bound, keep it off the event loop
+            row = await self.loop.run_in_executor(None,
+                scrape.parse_response,row,content,all_ahrefs_domains,dtime)
+        return row
+
+    async def scrape_rows(self,rows,all_ahrefs_domains):
+        return await asyncio.gather(*[
+            self.scrape_domain(row,all_ahrefs_domains) for row in rows
+        ])
+
+    async def fetch_to_queue(self,rows,out_queue,stopped=None):
+        # Fetch-only stage for pipeline.scrape_pipeline. At most concurrency
+        # rows are in flight, counting those waiting on a full out_queue, so
+        # response bodies can't pile up when the consumer falls behind. Once
+        # stopped (a threading.Event) is set, nothing more is fetched or put.
+        slots = asyncio.Semaphore(self.concurrency)
+
+        async def fetch_one(row):
+            try:
+                item = await self.fetch_domain(row)
+                await self.loop.run_in_executor(None,put_until_stopped,out_queue,item,stopped)
+            finally:
+                slots.release()
+
+        tasks = []
+        try:
+            for row in rows:
+                await slots.acquire()
+                if stopped is not None and stopped.is_set():
+                    break
+                tasks.append(asyncio.ensure_future(fetch_one(row)))
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def scrape_frame(self,df,all_ahrefs_domains):
+        rows = [row.copy() for _, row in df.iterrows()]
+        rows = self.run(self.scrape_rows(rows,all_ahrefs_domains))
+        return pd.DataFrame(rows)
+
+    def close(self):
+        self.run(self.session.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
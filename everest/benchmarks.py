@@ -0,0 +1,652 @@
+import time, random, threading
+import pandas as pd
+import sqlalchemy as sql
+from bs4 import BeautifulSoup
+
+from everest import scrape, extract, testserver, utils
+
+# Edge cases for extract.extract_page on top of the generated test pages
+EXTRACT_FIXTURES = [
+    ('a.test', b"<html><head><title>  A \n title </title></head><body><main><p>one</p> two</main>"
+               b"<div>outside <a href='http://x.test/'>x</a></div><main></main></body></html>"),
+    ('b.test', b"<html><body><footer>first footer<header>header in footer</header></footer>"
+               b"<p>text <!-- hidden --> more</p><a href='https://b.test/self'>self</a>"
+               b"<a href='HTTP://y.test/'>upper</a><a href='https://z.test/'>z</a><footer>kept</footer></body></html>"),
+    ('c.test', b"<html><body><header><a href='http://h.test/'>h</a><footer>in header</footer></header>"
+               b"<style>p {}</style><script>var a;</script><p>body &amp; text\t\r\n end</p>"
+               b"<footer><a href='http://f.test/'>f</a></footer></body></html>"),
+    ('d.test', b"<p>no body tag <a href='http://d2.test/'>link</a></p>"),
+    ('e.test', b"<html><head><title>only a title</title></head></html>"),
+    ('f.test', "<html><body><main>caf\u00e9 <main>nested</main> na\u00efve</main></body></html>".encode('utf-8')),
+]
+
+def extract_corpus(n_pages=200):
+    pages = [(site, page.encode('utf-8')) for site, page in
+             [('site{}.test'.format(i), testserver.make_page('site{}.test'.format(i))) for i in range(n_pages)]]
+    return pages + EXTRACT_FIXTURES
+
+def make_scrape_rows(domains):
+    return pd.DataFrame({
+        'domain': domains,
+        'url_https': 0,
+        'url_www': 0,
+        'total_backlinks': 1
+    })
+
+def benchmark_scrape(n_domains=500,latency=0.2,time_limit=2,concurrency=100,per_host=2,
+                     port=8765,sync=True):
+    # Scrape throughput against the local test server, no network needed.
+    # The sync path can't use the custom resolver, so it requests the same
+    # pages path-style from 127.0.0.1.
+    from everest import async_scrape
+
+    server = testserver.TestServer(port=port,latency=latency).start()
+    sites = ['site{}.test'.format(i) for i in range(n_domains)]
+    all_ahrefs_domains = utils.DomainIndex(sites)
+    results = []
+    try:
+        scraper = async_scrape.AsyncScraper(time_limit,concurrency,per_host,
+                                            resolver=testserver.LocalResolver(port))
+        try:
+            start = time.time()
+            scraped = scraper.scrape_frame(make_scrape_rows(sites),all_ahrefs_domains)
+            elapsed = time.time()-start
+        finally:
+            scraper.close()
+        results.append({
+            'mode': 'async',
+            'domains': n_domains,
+            'seconds': elapsed,
+            'domains_per_sec': n_domains/elapsed,
+            'successes': int((scraped['last_scrape_code']==200).sum())
+        })
+
+        if sync:
+            rows = make_scrape_rows(['127.0.0.1:{}/{}'.format(port,site) for site in sites])
+            start = time.time()
+            scraped = rows.apply(scrape.scrape_domain,axis=1,args=(all_ahrefs_domains,time_limit,))
+            elapsed = time.time()-start
+            results.append({
+                'mode': 'sync',
+                'domains': n_domains,
+                'seconds': elapsed,
+                'domains_per_sec': n_domains/elapsed,
+                'successes': int((scraped['last_scrape_code']==200).sum())
+            })
+    finally:
+        server.stop()
+    return pd.DataFrame(results).set_index('mode')
+
+def benchmark_work_queue(pg_engine,n_domains=200,n_workers=4,batch_size=10,latency=0.05,time_limit=2,
+                         port=8766):
+    # Runs n_workers queue workers in threads against the local test server,
+    # after a crashed worker has claimed a batch and let its lease expire.
+    # Reports throughput and checks every domain was scraped (and its page
+    # stored) and that only the crashed batch was claimed twice. pg_engine
+    # must be a scratch database, e.g. a local Postgres: scraped_domains,
+    # domains and scrape_queue are replaced.
+    from everest import async_scrape, workqueue
+    if utils.frame_from_pg("""SELECT to_regclass('domains') IS NOT NULL AS e""",pg_engine)['e'].iloc[0] in (True,'t'):
+        others = utils.frame_from_pg("""SELECT COUNT(*) AS n FROM domains WHERE referring_domain NOT LIKE '%.test'""",
+                                     pg_engine)
+        if others['n'].iloc[0] > 0:
+            raise ValueError('benchmark_work_queue replaces tables, so needs a scratch database.')
+
+    server = testserver.TestServer(port=port,latency=latency).start()
+    sites = ['site{}.test'.format(i) for i in range(n_domains)]
+    scrapers = [async_scrape.AsyncScraper(time_limit,100,2,resolver=testserver.LocalResolver(port))
+                for _ in range(n_workers)]
+    try:
+        # scraped_domains as a scrape leaves it, so its columns are whatever
+        # scrape_frame returns, then marked as never scraped
+        rows = make_scrape_rows(sites)
+        rows['first_seen'] = (pd.Timestamp('2019-01-01')+pd.to_timedelta(range(n_domains),unit='m')).astype(str)
+        scraped = scrapers[0].scrape_frame(rows.head(1),utils.DomainIndex(sites))
+        utils.frame_to_pg(pg_engine,pd.concat([scraped,rows.iloc[1:]],sort=False),'scraped_domains',['domain'])
+        utils.frame_to_pg(pg_engine,pd.DataFrame({'referring_domain': sites,'last_updated': pd.Timestamp.now()}),
+                          'domains',['referring_domain'])
+        conn = pg_engine.connect()
+        conn.execute("""UPDATE scraped_domains SET last_scrape_date = NULL, last_successful_scrape_date = NULL""")
+        conn.execute("""DROP TABLE IF EXISTS scrape_queue""")
+        conn.close()
+        workqueue.enqueue(pg_engine)
+
+        conn = pg_engine.raw_connection()
+        try:
+            crashed = workqueue.claim(conn,'crashed-worker',batch_size,1,3)
+        finally:
+            conn.close()
+        time.sleep(1.5)
+
+        # an engine each, as separate worker processes would have
+        completed = [0]*n_workers
+        def work(i):
+            engine = sql.create_engine(pg_engine.url)
+            try:
+                completed[i] = workqueue.run_worker(engine,'worker-{}'.format(i),batch_size,lease_seconds=60,
+                                                    mode='async',scraper=scrapers[i])
+            finally:
+                engine.dispose()
+        threads = [threading.Thread(target=work,args=(i,)) for i in range(n_workers)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time()-start
+    finally:
+        for scraper in scrapers:
+            scraper.close()
+        server.stop()
+
+    counts = utils.frame_from_pg("""SELECT COUNT(*) - COUNT(last_scrape_date) AS unscraped,
+                                           COUNT(last_successful_scrape_date) AS successes
+                                      FROM scraped_domains""",pg_engine)
+    queue = utils.frame_from_pg("""SELECT domain, attempts, completed_at IS NOT NULL AS completed FROM scrape_queue""",
+                                pg_engine)
+    queue['completed'] = queue['completed'].isin([True,'t'])
+    return pd.DataFrame([{
+        'workers': n_workers,
+        'domains': n_domains,
+        'seconds': elapsed,
+        'domains_per_sec': n_domains/elapsed,
+        'completed': sum(completed),
+        'unscraped': int(counts['unscraped'].iloc[0]),
+        'successes': int(counts['successes'].iloc[0]),
+        'crashed_batch_completed': int(queue[queue['domain'].isin(crashed)]['completed'].sum()),
+        'claimed_twice': int(((queue['attempts'] > 1) & ~queue['domain'].isin(crashed)).sum())
+    }])
+
+def benchmark_extract(pages=None,n_pages=200,parsers=('lxml','html.parser')):
+    # Pages/sec for BeautifulSoup + get_page_text against extract.extract_page
+    # with the same parser, language detection left out of both, and how many
+    # pages' outputs differ.
+    pages = pages if pages is not None else extract_corpus(n_pages)
+    results = []
+    for parser in parsers:
+        start = time.time()
+        current = [scrape.get_page_text(BeautifulSoup(content,parser),domain,detect_lang=False)[:3]
+                   for domain, content in pages]
+        current_elapsed = time.time()-start
+
+        start = time.time()
+        extracted = [extract.extract_page(content,domain,parser,detect_lang=False)[:3]
+                     for domain, content in pages]
+        extracted_elapsed = time.time()-start
+
+        results.append({'parser': parser,
+                        'get_page_text_pages_per_sec': len(pages)/current_elapsed,
+                        'extract_page_pages_per_sec': len(pages)/extracted_elapsed,
+                        'speedup': current_elapsed/extracted_elapsed,
+                        'mismatches': sum(1 for a, b in zip(current,extracted) if a != b)})
+    return pd.DataFrame(results).set_index('parser')
+
+def make_hosts(n_domains,n_hosts,seed=0):
+    rng = random.Random(seed)
+    tlds = ['com','net','org','co.uk','com.au','de','io','info']
+    domains = ['name{}.{}'.format(i,rng.choice(tlds)) for i in range(n_domains)]
+    hosts = []
+    for i in range(n_hosts):
+        kind = rng.random()
+        if kind < 0.3:
+            # a few hosts, like social networks, turn up on most pages
+            hosts.append(domains[int(rng.paretovariate(1))%n_domains])
+        elif kind < 0.4:
+            hosts.append(rng.choice(domains))
+        elif kind < 0.7:
+            hosts.append('{}.{}'.format(rng.choice(['www','blog','m','shop.eu']),rng.choice(domains)))
+        else:
+            hosts.append('other{}.{}'.format(rng.randrange(n_domains),rng.choice(tlds)))
+    return domains, hosts
+
+def benchmark_domain_index(n_domains=1000000,n_hosts=1000000,pg_engine=None):
+    # Build time and hosts/sec for get_matching_domain over a set against
+    # DomainIndex.match and match_many, checking all three agree. With
+    # pg_engine, also times rereading the domains table (what every scrape
+    # batch used to do) against getting the cached index.
+    domains, hosts = make_hosts(n_domains,n_hosts)
+    results = []
+
+    if pg_engine is not None:
+        start = time.time()
+        utils.get_all_ahrefs_domains(pg_engine)
+        results.append({'implementation': 'get_all_ahrefs_domains','build_seconds': time.time()-start})
+        utils.get_domain_index(pg_engine)
+        start = time.time()
+        utils.get_domain_index(pg_engine)
+        results.append({'implementation': 'get_domain_index (cached)','build_seconds': time.time()-start})
+
+    start = time.time()
+    domain_set = set(domains)
+    build = time.time()-start
+    start = time.time()
+    expected = [utils.get_matching_domain(host,domain_set)[0] for host in hosts]
+    elapsed = time.time()-start
+    results.append({'implementation': 'get_matching_domain (set)','build_seconds': build,
+                    'hosts_per_sec': n_hosts/elapsed,'mismatches': 0})
+
+    start = time.time()
+    index = utils.DomainIndex(domains)
+    build = time.time()-start
+    start = time.time()
+    matched = [index.match(host)[0] for host in hosts]
+    elapsed = time.time()-start
+    results.append({'implementation': 'DomainIndex.match','build_seconds': build,
+                    'hosts_per_sec': n_hosts/elapsed,
+                    'mismatches': sum(1 for a, b in zip(expected,matched) if a != b)})
+
+    start = time.time()
+    pairs = index.match_many(hosts)
+    elapsed = time.time()-start
+    matched = [match for match, error in pairs]
+    results.append({'implementation': 'DomainIndex.match_many','build_seconds': build,
+                    'hosts_per_sec': n_hosts/elapsed,
+                    'mismatches': sum(1 for a, b in zip(expected,matched) if a != b)})
+    return pd.DataFrame(results).set_index('implementation')
+
+def make_backlink_urls(n_urls,seed=0):
+    rng = random.Random(seed)
+    return pd.Series(['{}{}{}site{}.test/page{}?q={}'.format(
+        rng.choice(['http://','https://','"https://']),rng.choice(['','www.']),rng.choice(['','blog.']),
+        rng.randrange(n_urls//10+1),i,i) for i in range(n_urls)])
+
+def benchmark_split_urls(n_urls=1000000):
+    # urls/sec for apply(split_url) + zip into columns against split_urls
+    urls = make_backlink_urls(n_urls)
+    current = pd.DataFrame(index=urls.index)
+    start = time.time()
+    (
+        current['url_https'],
+        current['url_www'],
+        current['url_main'],
+        current['url_path'],
+        current['url_params'],
+        current['error_in_split_url']
+    ) = zip(*urls.apply(utils.split_url))
+    current_elapsed = time.time()-start
+
+    start = time.time()
+    split = utils.split_urls(urls)
+    split_elapsed = time.time()-start
+
+    columns = utils.SPLIT_URL_COLUMNS[:-1]
+    return pd.DataFrame([
+        {'implementation': 'apply(split_url)','urls_per_sec': n_urls/current_elapsed},
+        {'implementation': 'split_urls','urls_per_sec': n_urls/split_elapsed,
+         'mismatches': int((current[columns].fillna('') != split[columns].fillna('')).any(axis=1).sum())}
+    ]).set_index('implementation')
+
+# A few sentences per language, shuffled into long pages for benchmark_language
+LANGUAGE_SAMPLES = {
+    'en': ['Our team builds websites for small businesses across the region.',
+           'Contact us today for a free quote on your next project.',
+           'We have been helping local companies grow online since 2005.',
+           'Read the latest news and updates from our blog.'],
+    'fr': ['Notre équipe crée des sites internet pour les petites entreprises de la région.',
+           "Contactez-nous dès aujourd'hui pour obtenir un devis gratuit.",
+           'Nous aidons les entreprises locales à se développer en ligne depuis 2005.',
+           'Découvrez les dernières actualités de notre blog.'],
+    'de': ['Unser Team erstellt Webseiten für kleine Unternehmen in der Region.',
+           'Kontaktieren Sie uns noch heute für ein kostenloses Angebot.',
+           'Seit 2005 helfen wir lokalen Firmen, online zu wachsen.',
+           'Lesen Sie die neuesten Nachrichten aus unserem Blog.'],
+    'es': ['Nuestro equipo crea sitios web para pequeñas empresas de la región.',
+           'Contáctenos hoy para obtener un presupuesto gratuito.',
+           'Ayudamos a las empresas locales a crecer en internet desde 2005.',
+           'Lea las últimas noticias de nuestro blog.'],
+    'it': ['Il nostro team realizza siti web per le piccole imprese della regione.',
+           'Contattaci oggi per un preventivo gratuito.',
+           'Dal 2005 aiutiamo le aziende locali a crescere online.',
+           'Leggi le ultime notizie dal nostro blog.'],
+    'nl': ['Ons team bouwt websites voor kleine bedrijven in de regio.',
+           'Neem vandaag nog contact met ons op voor een gratis offerte.',
+           'Sinds 2005 helpen wij lokale bedrijven online te groeien.',
+           'Lees het laatste nieuws op onze blog.'],
+    'pt': ['A nossa equipa cria sites para pequenas empresas da região.',
+           'Contacte-nos hoje para obter um orçamento gratuito.',
+           'Desde 2005 ajudamos as empresas locais a crescer na internet.',
+           'Leia as últimas notícias do nosso blog.'],
+    'ru': ['Наша команда создаёт сайты для малого бизнеса в регионе.',
+           'Свяжитесь с нами сегодня, чтобы получить бесплатный расчёт.',
+           'С 2005 года мы помогаем местным компаниям расти в интернете.',
+           'Читайте последние новости в нашем блоге.'],
+}
+
+def language_corpus(n_texts=400,n_sentences=200,seed=0):
+    rng = random.Random(seed)
+    langs = sorted(LANGUAGE_SAMPLES)
+    texts = []
+    for i in range(n_texts):
+        sentences = LANGUAGE_SAMPLES[langs[i%len(langs)]]
+        texts.append(' '.join(rng.choice(sentences) for j in range(rng.randrange(1,n_sentences))))
+    return texts
+
+def benchmark_language(texts=None,labels=None,pg_engine=None,n_texts=400,
+                       max_chars=(None,5000,2000,500),chunks=1,seed=0):
+    # Texts/sec and agreement with the current labels for language detection
+    # on samples of different sizes. The reference labels are, in order of
+    # preference, the ones given, scraped_domains.lang for a sample of
+    # scraped pages when given pg_engine, or langdetect.detect on the whole
+    # text of a generated multilingual corpus.
+    from langdetect import detect
+    from everest import language
+    if texts is None and pg_engine is not None:
+        sample = utils.frame_from_pg("""SELECT main, lang FROM scraped_domains
+                                        WHERE main IS NOT NULL AND lang IS NOT NULL
+                                        ORDER BY md5(domain) LIMIT {}""".format(int(n_texts)),pg_engine)
+        texts = list(sample['main'].apply(utils.decode_text))
+        labels = list(sample['lang'])
+    texts = texts if texts is not None else language_corpus(n_texts)
+    results = []
+    if labels is None:
+        labels = []
+        start = time.time()
+        for text in texts:
+            try:
+                labels.append(detect(text))
+            except:
+                labels.append(language.NO_LANGUAGE)
+        results.append({'detector': 'langdetect.detect','texts_per_sec': len(texts)/(time.time()-start),
+                        'agreement': 1.0})
+    for chars in max_chars:
+        start = time.time()
+        langs = language.detect_languages(texts,chars,chunks,seed)
+        elapsed = time.time()-start
+        results.append({'detector': 'detect_language (max_chars={})'.format(chars),
+                        'texts_per_sec': len(texts)/elapsed,
+                        'agreement': sum(1 for a, b in zip(labels,langs) if a == b)/len(texts)})
+    return pd.DataFrame(results).set_index('detector')
+
+def benchmark_cluster_statistics(sizes=(1000,5000,20000),n_features=20000,words_per_page=200,seed=0):
+    # Seconds and result of pairwise_distances(X).mean(), the dense n x n way
+    # mean_distance used to be worked out, against cluster.cluster_statistics
+    # on random sparse tf-idf like rows. The dense version is skipped past
+    # 10000 rows, where it needs several GB.
+    import numpy as np
+    import scipy.sparse as sp
+    from sklearn.metrics import pairwise_distances
+    from sklearn.preprocessing import normalize
+    from everest import cluster
+    rng = np.random.RandomState(seed)
+    results = []
+    for n in sizes:
+        X = sp.random(n,n_features,density=words_per_page/n_features,format='csr',random_state=rng)
+        X = normalize(X)
+        domains = np.array(['site{}.test'.format(i) for i in range(n)])
+        result = {'rows': n}
+        if n <= 10000:
+            start = time.time()
+            result['dense_mean_distance'] = pairwise_distances(X).mean()
+            result['dense_seconds'] = time.time()-start
+        start = time.time()
+        statistics, distances = cluster.cluster_statistics(X,domains)
+        result['sparse_seconds'] = time.time()-start
+        result['sparse_mean_distance'] = statistics['mean_distance']
+        results.append(result)
+    return pd.DataFrame(results).set_index('rows')
+
+def topic_corpus(n_pages=5000,n_topics=50,vocabulary=20000,topic_words=200,page_words=150,noise=0.3,seed=0):
+    # Pages drawn from n_topics overlapping word lists plus a share of words
+    # from the whole vocabulary, for benchmarks that cluster text
+    import numpy as np
+    rng = np.random.RandomState(seed)
+    words = np.array(['w{}'.format(i) for i in range(vocabulary)])
+    topics = [rng.choice(vocabulary,topic_words,replace=False) for t in range(n_topics)]
+    pages = []
+    for i in range(n_pages):
+        n_noise = int(page_words*noise)
+        page = np.concatenate([rng.choice(topics[rng.randint(n_topics)],page_words-n_noise),
+                               rng.randint(vocabulary,size=n_noise)])
+        pages.append(' '.join(words[page]))
+    return pages
+
+def benchmark_reduction(pages=None,pg_engine=None,n_pages=5000,min_cluster_size=10,
+                        n_components=(None,200,100,50),max_features=None,max_df=1.0):
+    # Seconds, clusters found and agreement (adjusted Rand index) with the
+    # unreduced fit for cluster.cluster_language with different n_components.
+    # The pages are, in order of preference, the ones given, a sample of
+    # n_pages scraped pages in the most common language when given
+    # pg_engine, or a generated topic corpus.
+    from sklearn.metrics import adjusted_rand_score
+    from everest import cluster
+    if pages is None and pg_engine is not None:
+        sample = utils.frame_from_pg("""SELECT domain, main FROM scraped_domains
+                                         WHERE main IS NOT NULL
+                                               AND lang = (SELECT lang FROM scraped_domains
+                                                            WHERE main IS NOT NULL
+                                                         GROUP BY lang ORDER BY COUNT(*) DESC LIMIT 1)
+                                      ORDER BY md5(domain) LIMIT {}""".format(int(n_pages)),pg_engine)
+        pages = list(sample['main'].apply(utils.decode_text))
+    pages = pages if pages is not None else topic_corpus(n_pages)
+    frame = pd.DataFrame({'domain': ['site{}.test'.format(i) for i in range(len(pages))],'main': pages})
+    results = []
+    reference = None
+    for components in n_components:
+        start = time.time()
+        language_data, model = cluster.cluster_language('xx',frame.copy(),min_cluster_size,
+                                                        components,max_features,max_df)
+        elapsed = time.time()-start
+        labels = model.labels
+        if reference is None:
+            reference = labels
+        results.append({'n_components': components or 'unreduced','seconds': elapsed,
+                        'clusters': len(set(labels))-(1 if -1 in labels else 0),
+                        'noise_fraction': model.noise_fraction,
+                        'ari': adjusted_rand_score(reference,labels)})
+    return pd.DataFrame(results).set_index('n_components')
+
+def benchmark_incremental_recluster(pg_engine,n_pages=5000,new_fraction=0.05,min_cluster_size=10):
+    # Seconds for a full recluster of a generated topic corpus, then for an
+    # incremental one after new_fraction more pages are added and as many
+    # scraped again. scraped_domains is built as in use, with text date
+    # columns and bytea main, so the incremental run compares its dates with
+    # clusters.scrape_date as it would for real. stale counts the pages the
+    # run left out of clusters or with an old scrape date, and should be 0.
+    # pg_engine must be a scratch database: scraped_domains and clusters are
+    # replaced.
+    import shutil, tempfile
+    from everest import cluster
+    if utils.frame_from_pg("""SELECT to_regclass('scraped_domains') IS NOT NULL AS e""",pg_engine)['e'].iloc[0] in (True,'t'):
+        others = utils.frame_from_pg("""SELECT COUNT(*) AS n FROM scraped_domains WHERE domain NOT LIKE '%.test'""",
+                                     pg_engine)
+        if others['n'].iloc[0] > 0:
+            raise ValueError('benchmark_incremental_recluster replaces tables, so needs a scratch database.')
+
+    n_new = int(n_pages*new_fraction)
+    pages = topic_corpus(n_pages+n_new)
+    # dates as str(datetime.now()) leaves them in scrape_frame's rows
+    dates = pd.Timestamp('2021-01-01 00:00:00.123456')+pd.to_timedelta(range(n_pages+n_new),unit='s')
+    rows = pd.DataFrame({'domain': ['site{}.test'.format(i) for i in range(n_pages+n_new)],
+                         'lang': 'en',
+                         'main': [utils.encode_bytea(page) for page in pages],
+                         'last_scrape_date': dates.astype(str),
+                         'last_successful_scrape_date': dates.astype(str)})
+    def upload(rows):
+        utils.frame_to_pg(pg_engine,rows,'scraped_domains',['domain'])
+        conn = pg_engine.connect()
+        conn.execute("""ALTER TABLE scraped_domains ALTER COLUMN main TYPE bytea USING main::bytea""")
+        conn.close()
+    def stale():
+        return int(utils.frame_from_pg("""SELECT COUNT(*) AS n FROM scraped_domains AS sd
+                                           WHERE NOT EXISTS (
+                                                 SELECT 1 FROM clusters AS c
+                                                  WHERE c.domain = sd.domain
+                                                        AND c.scrape_date = sd.last_successful_scrape_date::timestamp)""",
+                                       pg_engine)['n'].iloc[0])
+
+    model_dir = tempfile.mkdtemp(prefix='everest_benchmark_models_')
+    results = []
+    try:
+        conn = pg_engine.connect()
+        conn.execute("""DROP TABLE IF EXISTS clusters""")
+        conn.close()
+        upload(rows.head(n_pages))
+        start = time.time()
+        cluster.recluster(pg_engine,min_cluster_size,model_dir=model_dir)
+        results.append({'run': 'full','pages': n_pages,'seconds': time.time()-start,'stale': stale()})
+
+        # n_new new pages, and as many old ones scraped again a day later
+        rescraped = rows.index[:n_new]
+        later = (pd.to_datetime(rows.loc[rescraped,'last_successful_scrape_date'])+pd.Timedelta(days=1)).astype(str)
+        rows.loc[rescraped,'last_scrape_date'] = later
+        rows.loc[rescraped,'last_successful_scrape_date'] = later
+        upload(rows)
+        start = time.time()
+        cluster.recluster(pg_engine,min_cluster_size,incremental=True,model_dir=model_dir)
+        results.append({'run': 'incremental','pages': 2*n_new,'seconds': time.time()-start,'stale': stale()})
+    finally:
+        shutil.rmtree(model_dir,ignore_errors=True)
+    return pd.DataFrame(results).set_index('run')
+
+def benchmark_near_duplicates(n_pages=(1000,10000,50000),clone_fraction=0.2,edit_fraction=0.01,threshold=0.8,seed=0):
+    # Pages/sec for MinHash signatures and for grouping them, on a topic
+    # corpus where clone_fraction of the pages are copies of another page
+    # with edit_fraction of their words changed. recall is the share of
+    # clones grouped with their original, false_groups the share of
+    # original pages wrongly grouped with another original.
+    import numpy as np
+    from everest import dedup
+    rng = np.random.RandomState(seed)
+    permutations = dedup.make_permutations()
+    bands, rows = dedup.lsh_params(threshold,len(permutations[0]))
+    results = []
+    for n in n_pages:
+        n_clones = int(n*clone_fraction)
+        pages = topic_corpus(n-n_clones,seed=seed)
+        originals = rng.randint(len(pages),size=n_clones)
+        for original in originals:
+            words = pages[original].split()
+            for i in rng.randint(len(words),size=int(len(words)*edit_fraction)):
+                words[i] = 'edit{}'.format(rng.randint(1000000))
+            pages.append(' '.join(words))
+        start = time.time()
+        signatures = np.array([dedup.minhash(page,permutations) for page in pages])
+        hash_seconds = time.time()-start
+        start = time.time()
+        labels = dedup.group_signatures(signatures,threshold,bands,rows)
+        group_seconds = time.time()-start
+        n_originals = n-n_clones
+        original_labels = labels[:n_originals]
+        results.append({'pages': n,'hash_pages_per_sec': n/hash_seconds,'group_pages_per_sec': n/group_seconds,
+                        'recall': float((labels[n_originals:] == labels[originals]).mean()),
+                        'false_groups': float(pd.Series(original_labels).duplicated(keep=False).mean())})
+    return pd.DataFrame(results).set_index('pages')
+
+def benchmark_streaming_vectorize(pages=None,n_pages=20000,page_words=1000,chunksize=2000,min_cluster_size=10):
+    # Seconds and peak memory (tracemalloc, text included) for vectorize on
+    # the whole corpus against StreamingVectorizer fed chunksize pages at a
+    # time from a generator, and the agreement (adjusted Rand index) of
+    # HDBSCAN clusters fit on each. The streamed text is generated a chunk
+    # at a time, as it would be read from the db.
+    import tracemalloc
+    import hdbscan
+    from sklearn.metrics import adjusted_rand_score
+    from everest import cluster
+    def chunks():
+        if pages is not None:
+            for i in range(0,len(pages),chunksize):
+                yield pages[i:i+chunksize]
+        else:
+            for i in range(0,n_pages,chunksize):
+                yield topic_corpus(min(chunksize,n_pages-i),page_words=page_words,seed=i)
+    results = []
+    labels = {}
+    for name in ['vectorize','StreamingVectorizer']:
+        tracemalloc.start()
+        start = time.time()
+        if name == 'vectorize':
+            tfv, X = cluster.vectorize([page for chunk in chunks() for page in chunk])
+        else:
+            X = cluster.StreamingVectorizer().fit_transform_chunks(chunks())
+        elapsed = time.time()-start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        labels[name] = hdbscan.HDBSCAN(min_cluster_size=min_cluster_size).fit(X).labels_
+        results.append({'vectorizer': name,'seconds': elapsed,'peak_mb': peak/1024**2,
+                        'nnz': X.nnz,'ari': adjusted_rand_score(labels['vectorize'],labels[name])})
+    return pd.DataFrame(results).set_index('vectorizer')
+
+def make_link_frame(n_domains,links_per_domain,seed=0):
+    # network_domains-like rows with encoded link lists; links mostly go to
+    # domains in the same block of 50, so the graph has many components
+    rng = random.Random(seed)
+    domains = ['site{}.test'.format(i) for i in range(n_domains)]
+    rows = []
+    for i, domain in enumerate(domains):
+        block = i - i%50
+        links = [domains[min(block+rng.randrange(50),n_domains-1)] for j in range(rng.randrange(links_per_domain*2))]
+        rows.append({'domain': domain,'domain_rating': rng.randrange(100),'organic_traffic': rng.randrange(10000),
+                     'links': utils.encode_link_list(links),'links_ahrefs_domains': utils.encode_link_list(links),
+                     'links_main_domains': utils.encode_link_list(links)})
+    return pd.DataFrame(rows)
+
+def networks_from_frame(frame,max_undo=20):
+    # network.Networks built from a make_link_frame frame instead of the db
+    from everest import network
+    networks = network.Networks.__new__(network.Networks)
+    networks.link_type = 'all_ahrefs_domains'
+    networks.max_undo = max_undo
+    networks.all_ahrefs_domains = frame
+    networks.network_domains = frame
+    networks.link_lists = {}
+    networks.reset_network_graph()
+    return networks
+
+def benchmark_network(n_domains=100000,links_per_domain=10):
+    # Seconds to decode links and build the graph and its component numbers
+    # the way Networks used to (decode_links row by row, add_edge per link,
+    # networkx components) against Networks' edge arrays and CSR matrix
+    import networkx as nx
+    frame = make_link_frame(n_domains,links_per_domain)
+
+    start = time.time()
+    decoded = frame.apply(utils.decode_links,axis=1)
+    G = nx.DiGraph()
+    for index in decoded.index:
+        domain_one = decoded.loc[index,'domain']
+        link_list = decoded.loc[index,'links_ahrefs_domains']
+        if link_list and isinstance(link_list,list):
+            for domain_two in link_list:
+                if domain_two != domain_one:
+                    G.add_edge(domain_one,domain_two)
+    components = sorted(list(nx.weakly_connected_components(G)),key=len,reverse=True)
+    networkx_elapsed = time.time()-start
+
+    start = time.time()
+    networks = networks_from_frame(frame)
+    csr_elapsed = time.time()-start
+
+    return pd.DataFrame([
+        {'implementation': 'networkx','seconds': networkx_elapsed,'components': len(components)},
+        {'implementation': 'edge arrays + CSR','seconds': csr_elapsed,'components': networks.component_info.shape[0],
+         'edges': len(networks.sources)},
+    ]).set_index('implementation')
+
+def benchmark_remove_nodes(n_domains=100000,links_per_domain=10,n_removals=20):
+    # Seconds per removal of the most linked domain left, for remove_node
+    # (which only re-splits that domain's component) against redoing
+    # update_network_info after each removal, and whether the two end with
+    # the same components
+    networks = networks_from_frame(make_link_frame(n_domains,links_per_domain),max_undo=n_removals)
+    hubs = list(networks.domain_info.index[:n_removals])
+
+    start = time.time()
+    for hub in hubs:
+        networks.remove_node(hub)
+    incremental_elapsed = time.time()-start
+    incremental = sorted(sorted(component) for component in networks.components if component)
+    for hub in hubs:
+        networks.undo()
+
+    start = time.time()
+    for hub in hubs:
+        networks.active[networks.nodes.get_loc(hub)] = False
+        networks.update_network_info()
+    full_elapsed = time.time()-start
+    full = sorted(sorted(component) for component in networks.components if component)
+
+    return pd.DataFrame([
+        {'implementation': 'update_network_info','seconds_per_removal': full_elapsed/n_removals},
+        {'implementation': 'remove_node','seconds_per_removal': incremental_elapsed/n_removals,
+         'same_components': incremental == full},
+    ]).set_index('implementation')
@@ -0,0 +1,136 @@
+import os, glob, hashlib, pickle, shutil, tempfile, zlib
+
+class ResponseCache:
+    # On-disk cache of scraped rows, one compressed pickle per domain that
+    # records when the domain was fetched. get() only returns entries fetched
+    # at or after 'since', so a scrape run can reuse its own fetches without
+    # picking up stale pages from older runs. Once the cache grows past
+    # max_bytes the least recently written entries are evicted.
+    def __init__(self,path=None,max_bytes=1024**3):
+        self.temporary = path is None
+        self.path = path if path else tempfile.mkdtemp(prefix='everest_scrape_cache_')
+        self.max_bytes = max_bytes
+        os.makedirs(self.path,exist_ok=True)
+        self.size = sum(os.path.getsize(f) for f in self.files())
+
+    def files(self):
+        return glob.glob(os.path.join(self.path,'*','*.pkl.z'))
+
+    def key_path(self,domain):
+        key = hashlib.sha1(domain.encode('utf-8')).hexdigest()
+        return os.path.join(self.path,key[:2],key+'.pkl.z')
+
+    def get(self,domain,since=None):
+        path = self.key_path(domain)
+        try:
+            with open(path,'rb') as f:
+                entry = pickle.loads(zlib.decompress(f.read()))
+        except (OSError, EOFError, zlib.error, pickle.UnpicklingError):
+            return None
+        if entry['domain'] != domain:
+            return None
+        if since is not None and (entry['fetch_time'] is None or entry['fetch_time'] < since):
+            return None
+        return entry['row']
+
+    def put(self,domain,fetch_time,row):
+        path = self.key_path(domain)
+        os.makedirs(os.path.dirname(path),exist_ok=True)
+        data = zlib.compress(pickle.dumps({'domain': domain,'fetch_time': fetch_time,'row': row}),1)
+        old_size = os.path.getsize(path) if os.path.exists(path) else 0
+        tmp_path = path+'.tmp'
+        with open(tmp_path,'wb') as f:
+            f.write(data)
+        os.replace(tmp_path,path)
+        self.size += len(data)-old_size
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def evict(self,target_fraction=0.9):
+        entries = sorted(((os.path.getmtime(f),os.path.getsize(f),f) for f in self.files()))
+        self.size = sum(size for _, size, _ in entries)
+        for mtime, size, f in entries:
+            if self.size <= self.max_bytes*target_fraction:
+                break
+            os.remove(f)
+            self.size -= size
+
+    def close(self):
+        if self.temporary:
+            shutil.rmtree(self.path,ignore_errors=True)
+
+class FeatureCache:
+    # On-disk cache of what clustering a language starts from, so reclusters
+    # of unchanged pages (or sweeps over clustering parameters) skip pulling,
+    # decoding and tokenizing the text again. Entries are keyed by a hash of
+    # the pages they were built from: the decoded text as a compressed
+    # pickle, and fitted tf-idf vectorizers with their sparse matrices as
+    # compressed .npz files. Reading an entry marks it as recently used, and
+    # once the cache grows past max_bytes the least recently used entries are
+    # evicted. Without a path it is a temporary one, removed by close().
+    def __init__(self,path=None,max_bytes=10*1024**3):
+        self.temporary = path is None
+        self.path = path if path else tempfile.mkdtemp(prefix='everest_feature_cache_')
+        self.max_bytes = max_bytes
+        os.makedirs(self.path,exist_ok=True)
+        self.size = sum(os.path.getsize(f) for f in self.files())
+
+    def files(self):
+        return [f for f in glob.glob(os.path.join(self.path,'*')) if not f.endswith('.tmp')]
+
+    def entry_path(self,key,suffix):
+        return os.path.join(self.path,key+suffix)
+
+    def read(self,key,suffix,load):
+        path = self.entry_path(key,suffix)
+        try:
+            with open(path,'rb') as f:
+                value = load(f)
+            os.utime(path)
+        except (OSError, EOFError, ValueError, zlib.error, pickle.UnpicklingError):
+            return None
+        return value
+
+    def write(self,key,suffix,dump):
+        path = self.entry_path(key,suffix)
+        old_size = os.path.getsize(path) if os.path.exists(path) else 0
+        tmp_path = path+'.tmp'
+        with open(tmp_path,'wb') as f:
+            dump(f)
+        os.replace(tmp_path,path)
+        self.size += os.path.getsize(path)-old_size
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def get_text(self,key):
+        return self.read(key,'.text.pkl.z',lambda f: pickle.loads(zlib.decompress(f.read())))
+
+    def put_text(self,key,texts):
+        self.write(key,'.text.pkl.z',lambda f: f.write(zlib.compress(pickle.dumps(texts),1)))
+
+    def get_features(self,key):
+        # (vectorizer, domains, matrix), or None if either half is missing
+        from scipy import sparse
+        meta = self.read(key,'.features.pkl.z',lambda f: pickle.loads(zlib.decompress(f.read())))
+        X = self.read(key,'.npz',sparse.load_npz) if meta is not None else None
+        if X is None:
+            return None
+        return meta[0], meta[1], X
+
+    def put_features(self,key,vectorizer,domains,X):
+        from scipy import sparse
+        self.write(key,'.npz',lambda f: sparse.save_npz(f,X))
+        self.write(key,'.features.pkl.z',lambda f: f.write(zlib.compress(pickle.dumps((vectorizer,domains)),1)))
+
+    def evict(self,target_fraction=0.9):
+        entries = sorted(((os.path.getmtime(f),os.path.getsize(f),f) for f in self.files()))
+        self.size = sum(size for _, size, _ in entries)
+        for mtime, size, f in entries:
+            if self.size <= self.max_bytes*target_fraction:
+                break
+            os.remove(f)
+            self.size -= size
+
+    def close(self):
+        if self.temporary:
+            shutil.rmtree(self.path,ignore_errors=True)
@@ -1,68 +1,583 @@
-import base64
+import os, hashlib, pickle, datetime, time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import pandas as pd
-from everest import utils
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics import pairwise_distances
+import scipy.sparse as sp
+from everest import utils, cache, dedup
+from sklearn.decomposition import TruncatedSVD
+from sklearn.feature_extraction.text import HashingVectorizer, TfidfTransformer, TfidfVectorizer
+from sklearn.pipeline import make_pipeline
+from sklearn.preprocessing import Normalizer
+from sklearn.metrics import pairwise_distances_chunked
+from sklearn.neighbors import NearestNeighbors
 import hdbscan
 
-def recluster(pg_engine, min_cluster_size = 10):
-    print('Pulling page data from db')
-    sql_query = """SELECT domain, main, lang 
-                     FROM scraped_domains 
+CLUSTER_COLUMNS = ['domain','lang','cluster','mean_distance','centroid_distance','medoid_domain','scrape_date']
+MODEL_VERSION = 3
+HASH_FEATURES = 2**20
+
+# Clusters up to this size get their exact mean pairwise distance, larger
+# ones an estimate from the distances of a random sample of this many
+# members to all the others
+EXACT_MEAN_DISTANCE_LIMIT = 5000
+MEAN_DISTANCE_SAMPLE = 1000
+
+def mean_pairwise_distance(X,exact_limit=EXACT_MEAN_DISTANCE_LIMIT,sample_size=MEAN_DISTANCE_SAMPLE,seed=0):
+    # Mean of the full n x n euclidean distance matrix (diagonal included,
+    # as pairwise_distances(X).mean() gives), summed block by block so it is
+    # never held whole. Past exact_limit only sample_size rows of it are
+    # summed, which makes the cost O(sample_size * n); as the rows are drawn
+    # uniformly the estimate is unbiased.
+    n = X.shape[0]
+    rows = X
+    if n > exact_limit:
+        rows = X[np.sort(np.random.RandomState(seed).choice(n,sample_size,replace=False))]
+    total = 0.0
+    for block in pairwise_distances_chunked(rows,X):
+        total += block.sum()
+    return total/(rows.shape[0]*n)
+
+def centroid_distances(X,centroid):
+    # ||x - c|| for every row from ||x||^2 - 2x.c + ||c||^2, in one pass over
+    # the sparse rows
+    squared = (np.asarray(X.multiply(X).sum(axis=1)).ravel()
+               - 2*np.asarray(X.dot(centroid)).ravel()
+               + centroid.dot(centroid))
+    return np.sqrt(np.maximum(squared,0))
+
+def cluster_statistics(X,domains):
+    # The medoid is taken to be the member closest to the centroid, which
+    # needs no pairwise distances
+    centroid = np.asarray(X.mean(axis=0)).ravel()
+    distances = centroid_distances(X,centroid)
+    return {'mean_distance': mean_pairwise_distance(X),
+            'medoid_domain': domains[distances.argmin()],
+            'centroid': centroid}, distances
+
+class ClusterModel:
+    # What incremental reclustering keeps per language: the fitted
+    # vectorizer, the training matrix and the parts of the HDBSCAN fit needed
+    # to place new pages in the existing clusters. hdbscan's own
+    # approximate_predict needs prediction_data, which it can't build for
+    # sparse tf-idf input, so predict follows the same steps here with a
+    # nearest neighbour search that does take sparse input (brute force
+    # there, a tree on reduced input). X is what HDBSCAN was fit on - the
+    # reduced matrix when there is a reducer - while cluster statistics are
+    # always in tf-idf space.
+    def __init__(self,language,vectorizer,reducer,clusterer,X,statistics):
+        self.version = MODEL_VERSION
+        self.language = language
+        self.vectorizer = vectorizer
+        self.reducer = reducer
+        self.X = X
+        self.labels = clusterer.labels_
+        self.min_samples = clusterer.min_samples or clusterer.min_cluster_size
+        self.statistics = statistics
+        self.n_fitted = X.shape[0]
+        self.n_predicted = 0
+        self.noise_fraction = float((self.labels == -1).mean())
+        self.fit_time = datetime.datetime.now()
+
+        k = min(self.min_samples,self.n_fitted)
+        self.core_distances = NearestNeighbors(n_neighbors=k).fit(X).kneighbors(X)[0][:,-1]
+
+        tree = clusterer.condensed_tree_.to_numpy()
+        self.point_parents = {int(child): (int(parent),lambda_val) for parent, child, lambda_val, size
+                              in zip(tree['parent'],tree['child'],tree['lambda_val'],tree['child_size'])
+                              if size == 1}
+        cluster_tree = tree[tree['child_size'] > 1]
+        self.cluster_parents = {int(child): (int(parent),lambda_val) for parent, child, lambda_val
+                                in zip(cluster_tree['parent'],cluster_tree['child'],cluster_tree['lambda_val'])}
+        self.root = int(tree['parent'].min()) if tree.shape[0] else None
+        # hdbscan numbers the selected clusters in order of their id in the
+        # condensed tree; anything below a selected cluster belongs to it
+        selected = sorted(clusterer.condensed_tree_._select_clusters())
+        self.cluster_map = {int(c): n for n, c in enumerate(selected)}
+        for child in self.cluster_parents:
+            parent = child
+            while parent is not None and parent not in self.cluster_map:
+                parent = self.cluster_parents.get(parent,(None,None))[0]
+            if parent is not None:
+                self.cluster_map[child] = self.cluster_map[parent]
+
+    def predict(self,X_new):
+        if not self.cluster_map or X_new.shape[0] == 0:
+            return np.full(X_new.shape[0],-1)
+        k = min(2*self.min_samples,self.n_fitted)
+        distances, indices = NearestNeighbors(n_neighbors=k).fit(self.X).kneighbors(X_new)
+        point_core = distances[:,min(self.min_samples,k-1)]
+        mutual_reachability = np.maximum(np.maximum(distances,self.core_distances[indices]),point_core[:,None])
+        labels = []
+        for i in range(X_new.shape[0]):
+            j = mutual_reachability[i].argmin()
+            lambda_ = 1/mutual_reachability[i,j] if mutual_reachability[i,j] > 0 else np.inf
+            cluster, neighbor_lambda = self.point_parents[int(indices[i,j])]
+            if neighbor_lambda > lambda_:
+                # the new page joins further up the tree than its neighbour
+                while cluster > self.root:
+                    parent, cluster_lambda = self.cluster_parents[cluster]
+                    if cluster_lambda < lambda_:
+                        break
+                    cluster = parent
+            labels.append(self.cluster_map.get(cluster,-1))
+        return np.array(labels)
+
+    def assign(self,language_data):
+        # Places new pages of this language in the fitted clusters, setting
+        # the same columns cluster_language does
+        X_new = self.vectorizer.transform(language_data['main'])
+        labels = self.predict(self.reducer.transform(X_new) if self.reducer else X_new)
+        language_data['cluster'] = [self.language + str(label) for label in labels]
+        names = language_data['cluster'].values
+        for name in set(names):
+            statistics = self.statistics.get(name)
+            if statistics is None:
+                continue
+            members = names == name
+            language_data.loc[members,'mean_distance'] = statistics['mean_distance']
+            language_data.loc[members,'medoid_domain'] = statistics['medoid_domain']
+            language_data.loc[members,'centroid_distance'] = centroid_distances(X_new[members],statistics['centroid'])
+        self.n_predicted += language_data.shape[0]
+        return language_data, labels
+
+    def save(self,model_dir):
+        os.makedirs(model_dir,exist_ok=True)
+        with open(os.path.join(model_dir,'{}.pkl'.format(self.language)),'wb') as f:
+            pickle.dump(self,f)
+
+def load_model(model_dir,language):
+    try:
+        with open(os.path.join(model_dir,'{}.pkl'.format(language)),'rb') as f:
+            model = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return None
+    # models saved by an older version are refit
+    return model if getattr(model,'version',None) == MODEL_VERSION else None
+
+def load_pages(pg_engine,condition='',text=True):
+    # With text=False each page's main is replaced by its md5, computed in
+    # postgres, and pages come in domain order; that is all a FeatureCache
+    # needs to find the language's features
+    sql_query = """SELECT domain, {}, lang, last_successful_scrape_date AS scrape_date
+                     FROM scraped_domains
                     WHERE last_successful_scrape_date IS NOT NULL
-                          AND main IS NOT NULL"""
-                    
-    clusters = utils.frame_from_pg(sql_query,pg_engine)
+                          AND main IS NOT NULL {} {}""".format(
+                          'main' if text else 'md5(main) AS main_hash',condition,'' if text else 'ORDER BY domain')
+    # decoded a chunk at a time so the encoded and decoded text of the whole
+    # corpus are never held together
+    chunks = []
+    for chunk in utils.frame_from_pg(sql_query,pg_engine,parse_dates=['scrape_date'],chunksize=10000):
+        if text:
+            chunk['main'] = chunk['main'].apply(utils.decode_text)
+        chunks.append(chunk)
+    pages = pd.concat(chunks,ignore_index=True)
+    pages['cluster'] = None
+    pages['mean_distance'] = np.nan
+    pages['centroid_distance'] = np.nan
+    pages['medoid_domain'] = None
+    return pages
 
-    clusters['main'] = clusters['main'].apply(base64.b64decode)
-    clusters['main'] = clusters['main'].str.decode('utf-8')
+def page_languages(pages):
+    return set([x for x in pages['lang'] if isinstance(x,str) and len(x) < 10])
 
-    hdb = hdbscan.HDBSCAN(min_cluster_size = min_cluster_size)
+def content_key(language_data):
+    digest = hashlib.md5()
+    for domain, main_hash in zip(language_data['domain'],language_data['main_hash']):
+        digest.update('{}:{}\n'.format(domain,main_hash).encode('utf-8'))
+    return digest.hexdigest()
+
+def vectorize(texts,max_features=None,max_df=1.0):
+    tfv = TfidfVectorizer(min_df=2,max_df=max_df,max_features=max_features)
+    X = tfv.fit_transform(texts)
+    # every pruned term, only kept for introspection and often most of the
+    # size of a pickled vectorizer
+    tfv.stop_words_ = None
+    return tfv, X
+
+class StreamingVectorizer:
+    # tf-idf fit a chunk of texts at a time, for languages too big to hold
+    # all their text at once. Words are hashed into n_features columns
+    # (HashingVectorizer, so there is no vocabulary to keep), the counts of
+    # each chunk are kept as a sparse matrix and document frequencies are
+    # added up as they go. Once every chunk is in, columns are pruned with
+    # min_df, max_df and max_features as TfidfVectorizer would and the idf
+    # weights fit on what's left. Apart from the odd hash collision this
+    # gives the same matrix as vectorize, with columns in hash order.
+    def __init__(self,n_features=HASH_FEATURES,min_df=2,max_df=1.0,max_features=None):
+        self.hasher = HashingVectorizer(n_features=n_features,alternate_sign=False,norm=None)
+        self.min_df = min_df
+        self.max_df = max_df
+        self.max_features = max_features
+
+    def fit_transform_chunks(self,chunks):
+        n_features = self.hasher.n_features
+        counts = []
+        document_frequency = np.zeros(n_features,dtype=np.int64)
+        for texts in chunks:
+            X = self.hasher.transform(texts)
+            document_frequency += np.bincount(X.indices,minlength=n_features)
+            counts.append(X)
+        X = sp.vstack(counts,format='csr') if counts else sp.csr_matrix((0,n_features))
+        del counts
+        n_documents = X.shape[0]
+        max_documents = self.max_df if isinstance(self.max_df,int) else self.max_df*n_documents
+        keep = (document_frequency >= self.min_df) & (document_frequency <= max_documents)
+        if self.max_features and keep.sum() > self.max_features:
+            totals = np.asarray(X.sum(axis=0)).ravel()
+            totals[~keep] = -1
+            keep = np.zeros(n_features,dtype=bool)
+            keep[np.argsort(-totals,kind='stable')[:self.max_features]] = True
+        if not keep.any():
+            raise ValueError('After pruning, no terms remain. Try a lower min_df or a higher max_df.')
+        self.columns = np.flatnonzero(keep)
+        X = X[:,self.columns]
+        self.tfidf = TfidfTransformer().fit(X)
+        return self.tfidf.transform(X,copy=False)
+
+    def transform(self,texts):
+        return self.tfidf.transform(self.hasher.transform(texts)[:,self.columns])
+
+def stream_language_features(pg_engine,language,language_data,max_features=None,max_df=1.0,chunksize=10000):
+    # Vectorizes a language's pages (loaded with text=False) with a
+    # StreamingVectorizer, reading and decoding chunksize pages of text at a
+    # time, so memory goes with the size of the sparse matrix rather than
+    # the text. Returns the vectorizer, the matrix in language_data's row
+    # order, and whether the pages read were exactly those in language_data.
+    sql_query = """SELECT domain, main
+                     FROM scraped_domains
+                    WHERE last_successful_scrape_date IS NOT NULL
+                          AND main IS NOT NULL AND lang = '{}'
+                 ORDER BY domain""".format(language.replace("'","''"))
+    domains_read = []
+    def chunks():
+        for chunk in utils.frame_from_pg(sql_query,pg_engine,chunksize=chunksize):
+            domains_read.extend(chunk['domain'])
+            yield (utils.decode_text(main) for main in chunk['main'])
+    tfv = StreamingVectorizer(max_df=max_df,max_features=max_features)
+    X = tfv.fit_transform_chunks(chunks())
+    domains = list(language_data['domain'])
+    if domains_read == domains:
+        return tfv, X, True
+    # pages changed in between: pages no longer there get empty rows
+    positions = pd.Series(np.arange(len(domains_read)),index=domains_read).reindex(domains)
+    X = sp.vstack([X,sp.csr_matrix((1,X.shape[1]))]).tocsr()
+    return tfv, X[positions.fillna(len(domains_read)).astype(int).values], False
+
+def language_features(pg_engine,feature_cache,language,language_data,max_features=None,max_df=1.0,streaming=False):
+    # The fitted vectorizer and tf-idf matrix for a language's pages (loaded
+    # with text=False), from feature_cache if the same pages have been
+    # vectorized the same way before. Otherwise the text comes from the cache
+    # too if it can, or from the db, and whatever was missing is cached.
+    # With streaming the features are built by stream_language_features and
+    # the text is never cached.
+    text_key = content_key(language_data)
+    features_key = hashlib.md5('{}:{}:{}:{}'.format(text_key,max_features,max_df,streaming).encode('utf-8')).hexdigest()
+    domains = list(language_data['domain'])
+    cached = feature_cache.get_features(features_key)
+    if cached is not None and cached[1] == domains:
+        return cached[0], cached[2]
+    if streaming:
+        tfv, X, complete = stream_language_features(pg_engine,language,language_data,max_features,max_df)
+        if complete:
+            feature_cache.put_features(features_key,tfv,domains,X)
+        return tfv, X
+    texts = feature_cache.get_text(text_key)
+    if texts is None or len(texts) != len(domains):
+        language_pages = load_pages(pg_engine,"AND lang = '{}'".format(language.replace("'","''")))
+        language_pages = language_pages.set_index('domain')['main'].reindex(domains)
+        complete = language_pages.notnull().all()
+        texts = list(language_pages.fillna(''))
+        if not complete:
+            # pages changed since language_data was read; use what there is
+            # but don't cache it under language_data's key
+            return vectorize(texts,max_features,max_df)
+        feature_cache.put_text(text_key,texts)
+    tfv, X = vectorize(texts,max_features,max_df)
+    feature_cache.put_features(features_key,tfv,domains,X)
+    return tfv, X
 
-    clusters['cluster'] = None
-    clusters['mean_distance'] = None
-
-    languages = set([x for x in clusters['lang'] if len(x) < 10])
-
-    for language in languages:
-        language_data = clusters[clusters['lang']==language].copy()
-        language_bodies = language_data['main'] 
-        try:    
-            tfv = TfidfVectorizer(min_df=2)
-            X_train_tf = tfv.fit_transform(language_bodies)
-
-            hdb.fit(X_train_tf)
-            language_data['cluster'] = hdb.labels_
-            language_data['cluster'] = language_data['cluster'].astype(str)
-            language_data['cluster'] = language + language_data['cluster']
-            
-            cluster_names = [cluster for cluster in language_data['cluster'].unique()
-                    if cluster
-                    and not '-' in cluster]
-            for cluster_name in cluster_names:
-                lab_tf = tfv.transform(language_data[language_data['cluster']==cluster_name]['main'])
-                dist = pairwise_distances(lab_tf)
-                mean_distance = dist.mean()
-                language_data.loc[language_data['cluster']==cluster_name,'mean_distance'] = mean_distance
-            
-            clusters.update(language_data[['cluster','mean_distance']])
-            print("Clustering complete for language code {}".format(language))
+def prepare_features(pg_engine,language_frames,feature_cache,streaming,max_features=None,max_df=1.0):
+    # Features for (language, pages) pairs loaded with text=False, from
+    # feature_cache and/or streamed. Returns the features by language and
+    # the languages that couldn't be vectorized.
+    features = {}
+    failed = []
+    for language, language_data in language_frames:
+        try:
+            if feature_cache:
+                features[language] = language_features(pg_engine,feature_cache,language,language_data,
+                                                       max_features,max_df,streaming)
+            else:
+                features[language] = stream_language_features(pg_engine,language,language_data,
+                                                              max_features,max_df)[:2]
         except Exception as e:
             print("Clustering failed for language code {} with error: {}".format(language,e))
-            language_data['cluster'] = language + '-clustering-failed'
-            clusters.update(language_data[['cluster']])
-    clusters = clusters.drop(columns=['main'])
+            failed.append(language)
+    return features, failed
+
+def make_reducer(n_components,n_features,seed=0):
+    # LSA: truncated SVD down to n_components, then unit length rows so
+    # euclidean distances between them behave like cosine distances
+    if not n_components or n_components >= n_features:
+        return None
+    return make_pipeline(TruncatedSVD(n_components,random_state=seed),Normalizer(copy=False))
+
+def cluster_language(language,language_data,min_cluster_size,n_components=None,max_features=None,max_df=1.0,
+                     features=None):
+    # Fits one language from scratch, returning its pages with cluster and
+    # mean_distance set, and the fitted model. With n_components the tf-idf
+    # matrix is reduced to that many dimensions before HDBSCAN, which can
+    # then use its tree based neighbour searches instead of brute force.
+    # features is a (vectorizer, matrix) pair from language_features to use
+    # instead of vectorizing language_data['main'].
+    tfv, X_train_tf = features if features is not None else vectorize(language_data['main'],max_features,max_df)
+    reducer = make_reducer(n_components,X_train_tf.shape[1])
+    X_train = reducer.fit_transform(X_train_tf) if reducer else X_train_tf
+
+    hdb = hdbscan.HDBSCAN(min_cluster_size = min_cluster_size)
+    hdb.fit(X_train)
+    language_data['cluster'] = hdb.labels_
+    language_data['cluster'] = language_data['cluster'].astype(str)
+    language_data['cluster'] = language + language_data['cluster']
+
+    statistics = {}
+    names = language_data['cluster'].values
+    domains = language_data['domain'].values
+    cluster_names = [cluster for cluster in language_data['cluster'].unique()
+            if cluster
+            and not '-' in cluster]
+    for cluster_name in cluster_names:
+        members = names == cluster_name
+        statistics[cluster_name], distances = cluster_statistics(X_train_tf[members],domains[members])
+        language_data.loc[members,'mean_distance'] = statistics[cluster_name]['mean_distance']
+        language_data.loc[members,'medoid_domain'] = statistics[cluster_name]['medoid_domain']
+        language_data.loc[members,'centroid_distance'] = distances
+    return language_data, ClusterModel(language,tfv,reducer,hdb,X_train,statistics)
+
+def refit_language(language,language_data,min_cluster_size,model_dir,**fit_options):
+    try:
+        language_data, model = cluster_language(language,language_data,min_cluster_size,**fit_options)
+        if model_dir:
+            model.save(model_dir)
+        print("Clustering complete for language code {}".format(language))
+    except Exception as e:
+        print("Clustering failed for language code {} with error: {}".format(language,e))
+        language_data['cluster'] = language + '-clustering-failed'
+    return language_data
+
+def limit_memory(memory_limit):
+    # Process pool initializer: caps each worker's address space so one
+    # oversized language fails with a MemoryError (and is marked
+    # '-clustering-failed') instead of taking the machine down
+    if memory_limit:
+        import resource
+        resource.setrlimit(resource.RLIMIT_AS,(int(memory_limit),int(memory_limit)))
+
+def refit_languages(language_frames,min_cluster_size,model_dir,workers=None,memory_limit=None,features=None,
+                    **fit_options):
+    # refit_language for a list of (language, pages) pairs, largest first,
+    # with each language's entry in features if there is one. With workers
+    # they run in that many processes; each language is fit on its own, so
+    # the results are the same as the serial path.
+    language_frames = sorted(language_frames,key=lambda frame: frame[1].shape[0],reverse=True)
+    features = features or {}
+    if not workers or workers <= 1 or len(language_frames) <= 1:
+        return [refit_language(language,language_data,min_cluster_size,model_dir,
+                               features=features.get(language),**fit_options)
+                for language, language_data in language_frames]
+    results = []
+    with ProcessPoolExecutor(max_workers=workers,initializer=limit_memory,initargs=(memory_limit,)) as executor:
+        futures = [(language,language_data,executor.submit(refit_language,language,language_data,min_cluster_size,model_dir,
+                                                                   features=features.get(language),**fit_options))
+                   for language, language_data in language_frames]
+        for language, language_data, future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                # the worker itself died, e.g. killed for running out of memory
+                print("Clustering failed for language code {} with error: {}".format(language,e))
+                language_data['cluster'] = language + '-clustering-failed'
+                results.append(language_data)
+    return results
+
+def can_update_incrementally(pg_engine,model_dir):
+    if not model_dir or not os.path.isdir(model_dir):
+        return False
+    try:
+        return set(CLUSTER_COLUMNS) <= set(utils.get_column_types(pg_engine,'clusters'))
+    except Exception:
+        return False
+
+def create_cluster_index(pg_engine):
+    # For Clusters pulling one cluster's rows and backlinks; frame_to_pg
+    # replaces the table, so this is redone after every full run
+    conn = pg_engine.connect()
+    conn.execute("""CREATE INDEX IF NOT EXISTS clusters_cluster ON clusters (cluster)""")
+    conn.close()
+
+def recluster(pg_engine, min_cluster_size = 10, incremental = False, model_dir = None,
+              refit_fraction = 0.2, drift_threshold = 0.1, workers = None, memory_limit = None,
+              n_components = None, max_features = None, max_df = 1.0,
+              cache_path = None, cache_max_bytes = 10*1024**3,
+              deduplicate = False, dedup_index = None, dedup_threshold = 0.8,
+              streaming = False):
+    # Clusters scraped pages by language and writes them to the clusters
+    # table. With model_dir, each language's fitted model (which holds its
+    # whole tf-idf matrix) is saved there for incremental runs. With workers,
+    # languages are fit in that many processes, largest first, each limited
+    # to memory_limit bytes if given. n_components, max_features and max_df
+    # are passed on to cluster_language. With cache_path, a full run reuses
+    # the features of languages whose pages haven't changed from a
+    # FeatureCache there, and only pulls text for the rest. With
+    # deduplicate, a full run first updates the near_duplicates table (see
+    # dedup.update_near_duplicates, keeping its index at dedup_index if
+    # given) and clusters one page per group of near duplicates, copying its
+    # results to the rest of the group. With streaming, languages being fit
+    # are vectorized by stream_language_features a chunk of text at a time
+    # instead of from text loaded all at once.
+    #
+    # With incremental=True only pages not yet clustered, or scraped again
+    # since, are read. They are placed in the saved clusters of their
+    # language and only their rows are written. A language is refit from
+    # scratch (all its pages, all its rows rewritten) when it has no saved
+    # model, when pages placed since its last fit pass refit_fraction of the
+    # pages it was fit on, or when a batch is labelled noise at a rate more
+    # than drift_threshold above the fit's own. Without model_dir, a saved
+    # model or a clusters table from this version, everything is refit as
+    # before.
+    fit_options = {'n_components': n_components,'max_features': max_features,'max_df': max_df}
+    feature_cache = cache.FeatureCache(cache_path,cache_max_bytes) if cache_path else None
+    # without a cache or streaming, languages being fit are vectorized from
+    # their text, loaded with the rest of their pages
+    text = feature_cache is None and not streaming
+    if incremental and not model_dir:
+        print('Incremental runs need the models saved in model_dir, refitting everything')
+    if incremental and can_update_incrementally(pg_engine,model_dir):
+        print('Pulling new and changed page data from db')
+        # scraped_domains' dates are text, clusters.scrape_date a timestamp
+        pages = load_pages(pg_engine,"""AND NOT EXISTS (
+                SELECT 1 FROM clusters AS c
+                 WHERE c.domain = scraped_domains.domain
+                       AND c.scrape_date = scraped_domains.last_successful_scrape_date::timestamp
+                       AND c.lang IS NOT DISTINCT FROM scraped_domains.lang)""")
+        print('{} new or changed pages'.format(pages.shape[0]))
+        updated = [pages[~pages['lang'].isin(page_languages(pages))]]
+        refits = []
+        for language in page_languages(pages):
+            language_data = pages[pages['lang']==language].copy()
+            model = load_model(model_dir,language)
+            refit = model is None or model.n_predicted + language_data.shape[0] > refit_fraction*model.n_fitted
+            if not refit:
+                language_data, labels = model.assign(language_data)
+                noise_fraction = float((labels == -1).mean())
+                if noise_fraction - model.noise_fraction > drift_threshold:
+                    print("Noise rate for language code {} rose from {:.2f} to {:.2f}".format(
+                        language,model.noise_fraction,noise_fraction))
+                    refit = True
+            if refit:
+                refits.append((language,load_pages(pg_engine,"AND lang = '{}'".format(language.replace("'","''")),text)))
+            else:
+                model.save(model_dir)
+                updated.append(language_data)
+                print("Assigned {} pages for language code {}".format(language_data.shape[0],language))
+        features = {}
+        if not text:
+            features, failed = prepare_features(pg_engine,refits,feature_cache,streaming,max_features,max_df)
+            for language, language_data in refits:
+                if language in failed:
+                    language_data['cluster'] = language + '-clustering-failed'
+                    updated.append(language_data)
+            refits = [refit for refit in refits if refit[0] in features]
+        updated += refit_languages(refits,min_cluster_size,model_dir,workers,memory_limit,features,**fit_options)
+        updated = pd.concat(updated,ignore_index=True)[CLUSTER_COLUMNS]
+        if updated.shape[0] > 0:
+            utils.update_pg_table(pg_engine,updated,'clusters',['domain'],'all')
+        create_cluster_index(pg_engine)
+        return
+
+    print('Pulling page data from db')
+    clusters = load_pages(pg_engine,text=text)
+    copies = pd.Series(False,index=clusters.index)
+    if deduplicate:
+        duplicates = dedup.update_near_duplicates(pg_engine,dedup_index,dedup_threshold)
+        duplicate_of = clusters['domain'].map(duplicates.set_index('domain')['duplicate_of'])
+        # a page only stands in for others clustered in the same language
+        copies = (duplicate_of.notnull() & (duplicate_of != clusters['domain'])
+                  & (duplicate_of.map(clusters.set_index('domain')['lang']) == clusters['lang']))
+        print('Clustering {} pages in place of {} near-duplicates'.format(
+            duplicate_of[copies].nunique(),copies.sum()))
+    language_frames = [(language,clusters[(clusters['lang']==language) & ~copies].copy())
+                       for language in page_languages(clusters)]
+    features = {}
+    if not text:
+        features, failed = prepare_features(pg_engine,language_frames,feature_cache,streaming,max_features,max_df)
+        for language, language_data in language_frames:
+            if language in failed:
+                clusters.loc[language_data.index,'cluster'] = language + '-clustering-failed'
+        language_frames = [frame for frame in language_frames if frame[0] in features]
+    for language_data in refit_languages(language_frames,min_cluster_size,model_dir,workers,memory_limit,
+                                         features,**fit_options):
+        clusters.update(language_data[['cluster','mean_distance','centroid_distance','medoid_domain']])
+    if copies.any():
+        columns = ['cluster','mean_distance','centroid_distance','medoid_domain']
+        clusters.loc[copies,columns] = clusters.set_index('domain').loc[duplicate_of[copies],columns].values
+    clusters = clusters[CLUSTER_COLUMNS]
     utils.frame_to_pg(pg_engine,clusters,'clusters',['domain'])
+    create_cluster_index(pg_engine)
+
+def sweep_min_cluster_size(pg_engine,min_cluster_sizes=(5,10,20,50),languages=None,
+                           cache_path=None,cache_max_bytes=10*1024**3,
+                           n_components=None,max_features=None,max_df=1.0,streaming=False):
+    # Clusters each language with every min_cluster_size, reporting how many
+    # clusters it finds and the share of pages left as noise. Nothing is
+    # written to the db; with cache_path, features come from (and are added
+    # to) the FeatureCache there, so repeated sweeps only run HDBSCAN.
+    feature_cache = cache.FeatureCache(cache_path,cache_max_bytes)
+    try:
+        pages = load_pages(pg_engine,text=False)
+        results = []
+        for language in sorted(languages or page_languages(pages)):
+            language_data = pages[pages['lang']==language]
+            try:
+                tfv, X = language_features(pg_engine,feature_cache,language,language_data,max_features,max_df,streaming)
+                reducer = make_reducer(n_components,X.shape[1])
+                X = reducer.fit_transform(X) if reducer else X
+            except Exception as e:
+                print("Clustering failed for language code {} with error: {}".format(language,e))
+                continue
+            for min_cluster_size in min_cluster_sizes:
+                start = time.time()
+                try:
+                    labels = hdbscan.HDBSCAN(min_cluster_size = min_cluster_size).fit(X).labels_
+                except Exception as e:
+                    print("Clustering failed for language code {} with error: {}".format(language,e))
+                    continue
+                results.append({'language': language,'min_cluster_size': min_cluster_size,
+                                'pages': X.shape[0],
+                                'clusters': len(set(labels))-(1 if -1 in labels else 0),
+                                'noise_fraction': float((labels == -1).mean()),
+                                'seconds': time.time()-start})
+    finally:
+        feature_cache.close()
+    return pd.DataFrame(results,columns=['language','min_cluster_size','pages','clusters','noise_fraction','seconds'])
 
 class Clusters:
-    def __init__(self,pg_engine):
+    # Clustered domains with their ahrefs data, for looking through in the
+    # Results notebook. Backlinks are only pulled when asked for: a cluster
+    # at a time through get_cluster_backlinks, or all of them the first time
+    # cluster_backlinks is used (or straight away with load_backlinks).
+    # Lookups by cluster go through a prebuilt cluster -> rows index.
+    def __init__(self,pg_engine,load_backlinks=False):
         self.pg_engine = pg_engine
+        self._cluster_backlinks = None
+        self.backlinks_by_cluster = {}
         self.pull_cluster_domains()
-        self.pull_cluster_backlinks()
+        if load_backlinks:
+            self.pull_cluster_backlinks()
         self.set_new_date_threshold()
         self.set_cluster_info()
         print("Cluster data ready")
-            
+
     def pull_cluster_domains(self):
         print("Pulling cluster domains from db")
         sql_query = """SELECT c.*, 
@@ -79,77 +594,76 @@ class Clusters:
                               LEFT JOIN domains AS d 
                               ON c.domain = d.referring_domain
                         WHERE cluster IS NOT NULL AND cluster NOT LIKE '%-%'"""
-        cluster_domains = utils.frame_from_pg(sql_query,self.pg_engine)
+        cluster_domains = utils.frame_from_pg(sql_query,self.pg_engine,
+                                              parse_dates=['last_successful_scrape_date','first_seen','last_updated'])
         self.cluster_domains = cluster_domains.set_index('domain')
+        self.cluster_codes = self.cluster_domains['cluster'].astype('category').cat
+        self.domain_rows = self.cluster_domains.groupby('cluster',sort=False).indices
 
-    def pull_cluster_backlinks(self):
-        print("Pulling cluster backlinks from db")
-        sql_query = """SELECT c.cluster, b.*
+    def backlinks_query(self,condition=''):
+        return """SELECT c.cluster, b.*
                  FROM clusters AS c 
                       LEFT JOIN url_main_domain_matches AS udm
                         ON c.domain = udm.matching_ahrefs_domain
                       LEFT JOIN backlinks AS b
                         ON b.url_main = udm.url_main
-                WHERE cluster IS NOT NULL AND cluster NOT LIKE '%-%'"""
-        cluster_backlinks = utils.frame_from_pg(sql_query,self.pg_engine)
-        self.cluster_backlinks = cluster_backlinks.set_index('referring_page_url')
+                WHERE cluster IS NOT NULL AND cluster NOT LIKE '%%-%%' {}""".format(condition)
+
+    def read_backlinks(self,condition='',params=()):
+        conn = self.pg_engine.raw_connection()
+        try:
+            sql_query = conn.cursor().mogrify(self.backlinks_query(condition),params).decode('utf-8')
+        finally:
+            conn.close()
+        cluster_backlinks = utils.frame_from_pg(sql_query,self.pg_engine,
+                                                parse_dates=['first_seen','last_check','day_lost','last_updated'])
+        cluster_backlinks = cluster_backlinks.set_index('referring_page_url')
+        if hasattr(self,'new_date_threshold'):
+            cluster_backlinks['new'] = cluster_backlinks['last_updated'] >= self.new_date_threshold
+        return cluster_backlinks
+
+    def pull_cluster_backlinks(self):
+        print("Pulling cluster backlinks from db")
+        self._cluster_backlinks = self.read_backlinks()
+        self.backlink_rows = self._cluster_backlinks.groupby('cluster',sort=False).indices
+
+    @property
+    def cluster_backlinks(self):
+        if self._cluster_backlinks is None:
+            self.pull_cluster_backlinks()
+        return self._cluster_backlinks
 
     def set_cluster_info(self):
-        cs = pd.DataFrame(
-            self.cluster_domains.groupby(['cluster']).size()
-                    ).rename(columns={0: 'num_domains'})
-        cs['language'] = cs.index.str[:2]
-        cs = cs[['language','num_domains']]
-        totals = self.cluster_domains.groupby(['cluster']).sum()[
-            ['new','live_backlinks','total_backlinks','organic_traffic']
-        ].rename(columns = {'new': 'num_new_domains',
-                           'live_backlinks': 'total_live_backlinks',
-                           'organic_traffic': 'total_organic_traffic'})
-        totals['num_new_domains'] = totals['num_new_domains'].astype(int)
-        maxes = self.cluster_domains.groupby(['cluster']).max()[
-            ['live_backlinks','total_backlinks','domain_rating','organic_traffic']
-        ].rename(
-            columns = {
-                'live_backlinks': 'max_live_backlinks',
-                'total_backlinks': 'max_backlinks',
-                'domain_rating': 'max_domain_rating',
-                'organic_traffic': 'max_organic_traffic'
-            }
-        )
-        means = self.cluster_domains.groupby(['cluster']).median()[
-            ['mean_distance','live_backlinks','total_backlinks','domain_rating','organic_traffic']
-        ].rename(
-            columns = {
-                'live_backlinks': 'mean_live_backlinks',
-                'total_backlinks': 'mean_backlinks',
-                'domain_rating': 'mean_domain_rating',
-                'organic_traffic': 'mean_organic_traffic'
-            }
-        )
-        cs = pd.merge(
-            cs,
-            totals,
-            how = 'left',
-            left_index = True,
-            right_index = True
-        )
-        cs = pd.merge(
-            cs,
-            means,
-            how = 'left',
-            left_index = True,
-            right_index = True
-        )
-        cs = pd.merge(
-            cs,
-            maxes,
-            how = 'left',
-            left_index = True,
-            right_index = True
+        # Everything but the new domain counts in one groupby; those are
+        # filled in by update_new_counts, which is all a new date threshold
+        # has to redo
+        cs = self.cluster_domains.groupby('cluster').agg(
+            num_domains = ('cluster','size'),
+            total_live_backlinks = ('live_backlinks','sum'),
+            total_backlinks = ('total_backlinks','sum'),
+            total_organic_traffic = ('organic_traffic','sum'),
+            mean_distance = ('mean_distance','median'),
+            mean_live_backlinks = ('live_backlinks','median'),
+            mean_backlinks = ('total_backlinks','median'),
+            mean_domain_rating = ('domain_rating','median'),
+            mean_organic_traffic = ('organic_traffic','median'),
+            max_live_backlinks = ('live_backlinks','max'),
+            max_backlinks = ('total_backlinks','max'),
+            max_domain_rating = ('domain_rating','max'),
+            max_organic_traffic = ('organic_traffic','max'),
         )
+        cs.insert(0,'language',cs.index.str[:2])
+        cs.insert(2,'num_new_domains',0)
         cs = cs.sort_values(['language','num_domains','mean_distance'],ascending=[True,False,True])
         self.cluster_info = cs
-        
+        self.update_new_counts()
+
+    def update_new_counts(self):
+        counts = np.bincount(self.cluster_codes.codes[self.cluster_domains['new'].values],
+                             minlength=len(self.cluster_codes.categories))
+        self.cluster_info['num_new_domains'] = pd.Series(counts,index=self.cluster_codes.categories).reindex(
+            self.cluster_info.index).astype(int)
+
     def set_new_date_threshold(self,date_string=None):
         if not date_string:
             self.new_date_threshold = min(
@@ -157,19 +671,33 @@ class Clusters:
                 self.cluster_domains['last_updated'].min()
             )
         else:
-            self.new_date_threshold = date_string
+            self.new_date_threshold = pd.to_datetime(date_string)
         self.cluster_domains['new'] = self.cluster_domains['last_updated'] >= self.new_date_threshold
-        self.cluster_backlinks['new'] = self.cluster_backlinks['last_updated'] >= self.new_date_threshold
+        for cluster_backlinks in [self._cluster_backlinks] + list(self.backlinks_by_cluster.values()):
+            if cluster_backlinks is not None:
+                cluster_backlinks['new'] = cluster_backlinks['last_updated'] >= self.new_date_threshold
+        if hasattr(self,'cluster_info'):
+            self.update_new_counts()
         print('Date threshold updated')
         
     def get_cluster_domains(self,cluster):
-        return self.cluster_domains[self.cluster_domains['cluster']==cluster]
+        return self.cluster_domains.iloc[self.domain_rows.get(cluster,[])]
 
     def get_cluster_backlinks(self,cluster):
-        return self.cluster_backlinks[self.cluster_backlinks['cluster']==cluster]
+        if self._cluster_backlinks is not None:
+            return self._cluster_backlinks.iloc[self.backlink_rows.get(cluster,[])]
+        if cluster not in self.backlinks_by_cluster:
+            self.backlinks_by_cluster[cluster] = self.read_backlinks('AND c.cluster = %s',(cluster,))
+        return self.backlinks_by_cluster[cluster]
 
     def get_cluster_domains_by_domain(self,domain):
         return self.get_cluster_domains(self.cluster_domains.loc[domain,'cluster'])
 
     def get_cluster_backlinks_by_url(self,url):
-        return self.get_cluster_backlinks(self.cluster_backlinks.loc[url,'cluster'])
\ No newline at end of file
+        if self._cluster_backlinks is not None:
+            return self.get_cluster_backlinks(self._cluster_backlinks.loc[url,'cluster'])
+        # the url's cluster, without pulling every backlink
+        clusters = self.read_backlinks('AND b.referring_page_url = %s',(url,))
+        if clusters.shape[0] == 0:
+            raise KeyError(url)
+        return self.get_cluster_backlinks(clusters['cluster'].iloc[0])
@@ -0,0 +1,197 @@
+import os, re, time, zlib
+import numpy as np
+import pandas as pd
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+from everest import utils
+
+# Near-duplicate detection for scraped pages. Templated clone sites have
+# almost the same text, which MinHash finds far more cheaply than
+# clustering: each page is reduced to a signature of num_perm minimum hashes
+# of its word shingles, where the share of positions two signatures agree
+# on estimates the Jaccard similarity of their shingle sets. Locality
+# sensitive hashing then splits the signatures into bands; pages that share
+# a band are candidates, and candidates at or above the threshold are
+# joined into groups. Signatures are kept on disk so later runs only hash
+# new or changed pages.
+
+MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+MAX_HASH = np.uint64((1 << 32) - 1)
+TOKEN_PATTERN = re.compile(r'\w+')
+
+def make_permutations(num_perm=128,seed=0):
+    rng = np.random.RandomState(seed)
+    return (rng.randint(1,(1 << 61) - 1,size=num_perm,dtype=np.uint64),
+            rng.randint(0,(1 << 61) - 1,size=num_perm,dtype=np.uint64))
+
+def shingle_hashes(text,shingle_size=5):
+    # 32 bit hashes of each run of shingle_size words, or of all the words
+    # for shorter texts; empty for texts without words
+    tokens = TOKEN_PATTERN.findall(text.lower()) if isinstance(text,str) else []
+    if not tokens:
+        return np.zeros(0,dtype=np.uint64)
+    hashes = np.array([zlib.crc32(token.encode('utf-8')) for token in tokens],dtype=np.uint64)
+    k = min(shingle_size,len(hashes))
+    shingles = hashes[:len(hashes)-k+1].copy()
+    for j in range(1,k):
+        shingles = shingles*np.uint64(1000003) ^ hashes[j:len(hashes)-k+1+j]
+    return np.unique(shingles & MAX_HASH)
+
+def minhash(text,permutations,shingle_size=5,chunksize=5000):
+    # The signature of a text: for each permutation (a*h + b) mod p, the
+    # smallest value over its shingles. Texts without words get all MAX_HASH,
+    # which is_valid tells apart.
+    a, b = permutations
+    signature = np.full(len(a),MAX_HASH,dtype=np.uint64)
+    shingles = shingle_hashes(text,shingle_size)
+    for i in range(0,len(shingles),chunksize):
+        permuted = ((shingles[i:i+chunksize,None]*a + b) % MERSENNE_PRIME) & MAX_HASH
+        signature = np.minimum(signature,permuted.min(axis=0))
+    return signature.astype(np.uint32)
+
+def is_valid(signatures):
+    return (signatures != np.uint32(MAX_HASH)).any(axis=1)
+
+def lsh_params(threshold,num_perm):
+    # Bands and rows per band whose S-curve (1/bands)^(1/rows) is closest to
+    # the threshold, so pages about that similar are even odds as candidates
+    options = [(num_perm//rows,rows) for rows in range(1,num_perm+1) if num_perm//rows > 0]
+    return min(options,key=lambda option: abs((1/option[0])**(1/option[1])-threshold))
+
+def group_signatures(signatures,threshold,bands,rows,seed=0):
+    # Component id for every signature (-1 for texts without words). Within
+    # each band bucket, members are compared with the bucket's first member
+    # and joined to it at or above threshold, which keeps the work linear in
+    # bucket size; pairs this misses in one band are nearly always joined
+    # through another.
+    n = signatures.shape[0]
+    valid = np.flatnonzero(is_valid(signatures))
+    multipliers = np.random.RandomState(seed).randint(1,1 << 62,size=rows,dtype=np.uint64) | np.uint64(1)
+    sources = []
+    targets = []
+    for band in range(bands):
+        band_signatures = signatures[valid,band*rows:(band+1)*rows]
+        keys = (band_signatures.astype(np.uint64)*multipliers).sum(axis=1)
+        unique, first, inverse = np.unique(keys,return_index=True,return_inverse=True)
+        first = first[inverse]
+        candidates = np.flatnonzero(first != np.arange(len(valid)))
+        if len(candidates) == 0:
+            continue
+        similarity = (signatures[valid[candidates]] == signatures[valid[first[candidates]]]).mean(axis=1)
+        joined = candidates[similarity >= threshold]
+        sources.append(valid[joined])
+        targets.append(valid[first[joined]])
+    sources = np.concatenate(sources) if sources else np.zeros(0,dtype=np.int64)
+    targets = np.concatenate(targets) if targets else np.zeros(0,dtype=np.int64)
+    graph = coo_matrix((np.ones(len(sources)),(sources,targets)),shape=(n,n))
+    labels = connected_components(graph,directed=False)[1]
+    labels[~is_valid(signatures)] = -1
+    return labels
+
+class NearDuplicateIndex:
+    # MinHash signatures of scraped pages, saved at path with the md5 of the
+    # text each was made from, so update only hashes pages that are new or
+    # have changed since.
+    def __init__(self,path=None,num_perm=128,shingle_size=5,seed=0):
+        self.path = path
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        self.seed = seed
+        self.domains = np.zeros(0,dtype=object)
+        self.main_hashes = np.zeros(0,dtype=object)
+        self.signatures = np.zeros((0,num_perm),dtype=np.uint32)
+        if path and os.path.exists(path):
+            self.load()
+        self.permutations = make_permutations(self.num_perm,self.seed)
+
+    def load(self):
+        with np.load(self.path,allow_pickle=True) as data:
+            settings = (int(data['num_perm']),int(data['shingle_size']),int(data['seed']))
+            if settings != (self.num_perm,self.shingle_size,self.seed):
+                # signatures made differently can't be compared; start over
+                return
+            self.domains = data['domains']
+            self.main_hashes = data['main_hashes']
+            self.signatures = data['signatures']
+
+    def save(self):
+        tmp_path = self.path+'.tmp'
+        with open(tmp_path,'wb') as f:
+            np.savez_compressed(f,domains=self.domains,main_hashes=self.main_hashes,signatures=self.signatures,
+                                num_perm=self.num_perm,shingle_size=self.shingle_size,seed=self.seed)
+        os.replace(tmp_path,self.path)
+
+    def update(self,pg_engine,scrape_condition='',batch_size=1000):
+        # Brings the index in line with scraped_domains: drops pages no
+        # longer there and hashes new and changed ones, pulling the text of
+        # batch_size of them at a time. Returns how many were hashed.
+        current = utils.frame_from_pg("""SELECT domain, md5(main) AS main_hash FROM scraped_domains
+                                          WHERE main IS NOT NULL {}
+                                       ORDER BY domain""".format(scrape_condition),pg_engine)
+        known = pd.Series(self.main_hashes,index=self.domains)
+        changed = current[current['main_hash'].values != known.reindex(current['domain']).values]
+        unchanged = ~current['domain'].isin(changed['domain'])
+        positions = pd.Series(np.arange(len(self.domains)),index=self.domains)
+        signatures = np.full((current.shape[0],self.num_perm),np.uint32(MAX_HASH),dtype=np.uint32)
+        signatures[unchanged.values] = self.signatures[positions.reindex(current.loc[unchanged,'domain']).values]
+
+        # hashes of the text actually hashed, so pages that change (or go)
+        # while this runs are picked up next time
+        main_hashes = current['main_hash'].values.astype(object)
+        main_hashes[~unchanged.values] = None
+        rows = pd.Series(np.arange(current.shape[0]),index=current['domain'])
+        conn = pg_engine.raw_connection()
+        try:
+            start = time.time()
+            domains = list(changed['domain'])
+            for i in range(0,len(domains),batch_size):
+                sql_query = conn.cursor().mogrify(
+                    """SELECT domain, main, md5(main) AS main_hash FROM scraped_domains WHERE domain = ANY(%s)""",
+                    (domains[i:i+batch_size],)).decode('utf-8')
+                batch = utils.frame_from_pg(sql_query,pg_engine)
+                for domain, main, main_hash in zip(batch['domain'],batch['main'],batch['main_hash']):
+                    signatures[rows[domain]] = minhash(utils.decode_text(main),self.permutations,self.shingle_size)
+                    main_hashes[rows[domain]] = main_hash
+                print('Hashed {} of {} new or changed pages. Elapsed time: {}'.format(
+                    min(i+batch_size,len(domains)),len(domains),time.time()-start))
+        finally:
+            conn.close()
+        self.domains = current['domain'].values.astype(object)
+        self.main_hashes = main_hashes
+        self.signatures = signatures
+        if self.path:
+            self.save()
+        return changed.shape[0]
+
+    def groups(self,threshold=0.8):
+        # One row per page with at least one near-duplicate: its group's
+        # representative (the first domain in it), the group size and the
+        # estimated similarity to the representative
+        bands, rows = lsh_params(threshold,self.num_perm)
+        labels = group_signatures(self.signatures,threshold,bands,rows,self.seed)
+        groups = pd.DataFrame({'domain': self.domains,'group': labels})
+        groups = groups[groups['group'] >= 0]
+        groups['group_size'] = groups.groupby('group')['domain'].transform('size')
+        groups = groups[groups['group_size'] > 1]
+        first = groups.groupby('group')['domain'].transform('min')
+        positions = pd.Series(np.arange(len(self.domains)),index=self.domains)
+        groups['duplicate_of'] = first.values
+        groups['similarity'] = (self.signatures[positions[groups['domain']].values]
+                                == self.signatures[positions[first].values]).mean(axis=1)
+        return groups[['domain','duplicate_of','group_size','similarity']].reset_index(drop=True)
+
+def update_near_duplicates(pg_engine,index_path=None,threshold=0.8,num_perm=128,
+                           shingle_size=5,batch_size=1000):
+    # Updates the index from scraped_domains and rewrites the near_duplicates
+    # table: every page whose text is at least threshold similar (estimated
+    # Jaccard over word shingles) to another's, with the domain that stands
+    # for its group. Returns the table as a frame. The index is only loaded
+    # from and saved to index_path when one is given; without it every run
+    # reads all of scraped_domains.
+    index = NearDuplicateIndex(index_path,num_perm,shingle_size)
+    index.update(pg_engine,batch_size=batch_size)
+    groups = index.groups(threshold)
+    utils.frame_to_pg(pg_engine,groups,'near_duplicates',['domain'])
+    print('Found {} near-duplicate pages in {} groups'.format(groups.shape[0],groups['duplicate_of'].nunique()))
+    return groups
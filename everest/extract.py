@@ -0,0 +1,206 @@
+import re
+from bs4 import BeautifulSoup
+from bs4.dammit import EncodingDetector
+from bs4.element import Tag, Comment, NavigableString, CData
+
+try:
+    from lxml import etree
+except ImportError:
+    etree = None
+
+from everest import language
+
+# Single pass replacement for scrape.get_page_text. Title, visible main text and
+# outbound links are collected from one stream of start/end/text events, which
+# comes either straight from lxml's parser (no tree is built) or from a walk
+# over an existing BeautifulSoup tree. Output matches get_page_text:
+#  - title is the text of the first <title>
+#  - main is the visible text of each <main>, or failing that of the first
+#    <body> without its first <header> and first <footer>
+#  - links are absolute hrefs not containing the domain; like get_page_text,
+#    links in that header/footer are dropped when the page has no <main>
+
+INVISIBLE_PARENTS = set(['style', 'script', 'head', 'title', 'meta', '[document]'])
+LINK_PATTERN = re.compile('^https?://')
+
+def normalize_text(strings):
+    string = u" ".join(t.strip() for t in strings)
+    string = string.replace('\n', ' ').replace('\t', ' ').replace('\r', ' ')
+    string = re.sub(' +',' ',string).strip()
+    return string
+
+class PageCollector:
+    def __init__(self,domain):
+        self.domain = domain
+        self.tags = []
+        self.title = None
+        self.title_depth = None
+        self.title_done = False
+        self.mains = []
+        self.open_mains = []
+        self.body = None
+        self.body_depth = None
+        self.header_depth = None
+        self.header_done = False
+        self.footer_depth = None
+        self.footer_done = False
+        self.links = []
+
+    def start(self,tag,attrs):
+        self.tags.append(tag)
+        depth = len(self.tags)
+        if tag == 'title' and not self.title_done and self.title_depth is None:
+            self.title = []
+            self.title_depth = depth
+        elif tag == 'main':
+            self.open_mains.append([])
+            self.mains.append(self.open_mains[-1])
+        elif tag == 'body' and self.body is None:
+            self.body = []
+            self.body_depth = depth
+        elif self.body_depth is not None:
+            if tag == 'header' and not self.header_done and self.header_depth is None:
+                self.header_depth = depth
+            elif (tag == 'footer' and not self.footer_done and self.footer_depth is None
+                  and self.header_depth is None):
+                self.footer_depth = depth
+        if tag == 'a':
+            href = attrs.get('href')
+            if isinstance(href,str) and LINK_PATTERN.search(href):
+                skipped = self.header_depth is not None or self.footer_depth is not None
+                self.links.append((href,skipped))
+
+    def end(self,tag):
+        depth = len(self.tags)
+        if depth == self.title_depth:
+            self.title_depth = None
+            self.title_done = True
+        if depth == self.header_depth:
+            self.header_depth = None
+            self.header_done = True
+        if depth == self.footer_depth:
+            self.footer_depth = None
+            self.footer_done = True
+        if depth == self.body_depth:
+            self.body_depth = None
+        if tag == 'main' and self.open_mains:
+            self.open_mains.pop()
+        if self.tags:
+            self.tags.pop()
+
+    def text(self,string,comment=False,title_text=True):
+        if self.title_depth is not None and title_text and not comment:
+            self.title.append(string)
+        if comment:
+            return
+        parent = self.tags[-1] if self.tags else '[document]'
+        if parent in INVISIBLE_PARENTS:
+            return
+        for main in self.open_mains:
+            main.append(string)
+        if (self.body_depth is not None
+            and self.header_depth is None
+            and self.footer_depth is None):
+            self.body.append(string)
+
+    def result(self):
+        title = None
+        if self.title is not None:
+            title = re.sub('\s+',' ',''.join(self.title))
+        if self.mains:
+            main = ' '.join([normalize_text(main) for main in self.mains])
+            links = [href for href, skipped in self.links]
+        else:
+            main = normalize_text(self.body) if self.body is not None else None
+            links = [href for href, skipped in self.links if not skipped]
+        links = [href for href in links if self.domain not in href]
+        return title, main, links
+
+class LxmlTarget:
+    # lxml parser target, buffers text so that split data events become the
+    # same single strings BeautifulSoup would hand to get_page_text
+    def __init__(self,collector):
+        self.collector = collector
+        self.buffer = []
+
+    def flush(self):
+        if self.buffer:
+            self.collector.text(''.join(self.buffer))
+            self.buffer = []
+
+    def start(self,tag,attrib):
+        self.flush()
+        self.collector.start(tag,attrib)
+
+    def end(self,tag):
+        self.flush()
+        self.collector.end(tag)
+
+    def data(self,data):
+        self.buffer.append(data)
+
+    def comment(self,text):
+        self.flush()
+        self.collector.text(text,comment=True)
+
+    def pi(self,target,data=None):
+        self.flush()
+        self.collector.text(target+' '+(data or ''),title_text=False)
+
+    def doctype(self,*args):
+        self.flush()
+
+    def close(self):
+        self.flush()
+        return self.collector.result()
+
+def extract_lxml(content,domain):
+    if isinstance(content,str):
+        content = content.encode('utf-8')
+        encoding = 'utf-8'
+    else:
+        detector = EncodingDetector(content,is_html=True)
+        encoding = next(iter(detector.encodings),None)
+        content = detector.markup
+    parser = etree.HTMLParser(target=LxmlTarget(PageCollector(domain)),
+                              encoding=encoding,
+                              recover=True,
+                              strip_cdata=False)
+    parser.feed(content)
+    return parser.close()
+
+def extract_soup(soup,domain):
+    collector = PageCollector(domain)
+    iterators = [iter(soup.contents)]
+    tags = []
+    while iterators:
+        child = next(iterators[-1],None)
+        if child is None:
+            iterators.pop()
+            if tags:
+                collector.end(tags.pop().name)
+        elif isinstance(child,Tag):
+            collector.start(child.name,child.attrs)
+            tags.append(child)
+            iterators.append(iter(child.contents))
+        else:
+            collector.text(child,
+                           comment=isinstance(child,Comment),
+                           title_text=type(child) in (NavigableString,CData))
+    return collector.result()
+
+def extract_page(content,domain,parser='lxml',detect_lang=True):
+    # Drop-in for BeautifulSoup(content) + scrape.get_page_text. parser='lxml'
+    # streams through lxml when it is installed, any other value is handed to
+    # BeautifulSoup as its parser and the resulting tree walked once.
+    # Language is detected on a seeded sample of main, see language.py.
+    try:
+        if parser == 'lxml' and etree is not None:
+            title, main, links = extract_lxml(content,domain)
+        else:
+            soup = BeautifulSoup(content,'html.parser' if parser == 'lxml' else parser)
+            title, main, links = extract_soup(soup,domain)
+        lang = language.detect_language(main) if detect_lang else None
+        return title, main, links, lang, None
+    except Exception as e:
+        return None, None, None, None, str(e)
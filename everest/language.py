@@ -0,0 +1,95 @@
+import re, time
+from concurrent.futures import ProcessPoolExecutor
+from langdetect.detector_factory import DetectorFactory, PROFILES_DIRECTORY
+from langdetect.lang_detect_exception import LangDetectException
+
+from everest import utils
+
+# Language identification for scraped pages. langdetect.detect runs on the
+# whole text (its own cut off is 10000 characters, after regex passes over
+# all of it) with an unseeded random number generator, so it is slow on long
+# pages and can label the same page differently from one run to the next.
+# Here detection runs on a bounded sample of the text - a prefix, or several
+# slices spread through it - with a fixed seed, reusing one set of loaded
+# profiles for every document.
+
+NO_LANGUAGE = "Can't detect language - no text, or langdetect not installed"
+MAX_CHARS = 2000
+
+_factory = None
+
+def get_factory():
+    global _factory
+    if _factory is None:
+        factory = DetectorFactory()
+        factory.load_profile(PROFILES_DIRECTORY)
+        _factory = factory
+    return _factory
+
+def sample_text(text,max_chars=MAX_CHARS,chunks=1):
+    # The first max_chars characters, or with chunks > 1 that many evenly
+    # spaced slices adding up to max_chars
+    if max_chars is None or len(text) <= max_chars:
+        return text
+    if chunks <= 1:
+        return text[:max_chars]
+    size = max_chars//chunks
+    step = (len(text)-size)//(chunks-1)
+    return ' '.join(text[i*step:i*step+size] for i in range(chunks))
+
+def detect_language(text,max_chars=MAX_CHARS,chunks=1,seed=0):
+    try:
+        detector = get_factory().create()
+        detector.seed = seed
+        detector.append(sample_text(text,max_chars,chunks))
+        return detector.detect()
+    except (LangDetectException, AttributeError, TypeError):
+        return NO_LANGUAGE
+
+def detect_language_batch(texts,max_chars=MAX_CHARS,chunks=1,seed=0):
+    return [detect_language(text,max_chars,chunks,seed) for text in texts]
+
+def detect_languages(texts,max_chars=MAX_CHARS,chunks=1,seed=0,workers=None,batch_size=100):
+    # Languages for a list of texts, in order. With workers the texts are
+    # split into batches detected in that many processes; each result only
+    # depends on its own text and the seed, so the output is the same.
+    texts = list(texts)
+    if not workers or workers <= 1:
+        return detect_language_batch(texts,max_chars,chunks,seed)
+    batches = [texts[i:i+batch_size] for i in range(0,len(texts),batch_size)]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(detect_language_batch,batches,
+                               [max_chars]*len(batches),[chunks]*len(batches),[seed]*len(batches))
+        return [lang for batch in results for lang in batch]
+
+def backfill_languages(pg_engine,scrape_condition='WHERE main IS NOT NULL',batch_size=1000,
+                       max_chars=MAX_CHARS,chunks=1,seed=0,workers=None):
+    # Re-detects scraped_domains.lang from the stored main text, without
+    # scraping again. Works through matching domains in batches ordered by
+    # domain, so it can be stopped and picked up again with a condition such
+    # as "WHERE lang IS NULL".
+    start = time.time()
+    # the caller's condition is bracketed so an OR in it can't take in rows
+    # before last_domain
+    condition = re.sub(r'^\s*WHERE\s+','',scrape_condition or '',flags=re.IGNORECASE) or 'TRUE'
+    last_domain = None
+    updated = 0
+    while True:
+        conn = pg_engine.raw_connection()
+        try:
+            sql_query = conn.cursor().mogrify(
+                """SELECT domain, main FROM scraped_domains WHERE ({}) {} ORDER BY domain LIMIT %s""".format(
+                    condition.replace('%','%%'),'AND domain > %s' if last_domain is not None else ''),
+                ((last_domain,) if last_domain is not None else ())+(int(batch_size),)).decode('utf-8')
+        finally:
+            conn.close()
+        batch = utils.frame_from_pg(sql_query,pg_engine)
+        if batch.shape[0] == 0:
+            break
+        last_domain = batch['domain'].iloc[-1]
+        texts = batch['main'].apply(utils.decode_text)
+        batch['lang'] = detect_languages(texts,max_chars,chunks,seed,workers)
+        utils.update_pg_table(pg_engine,batch[['domain','lang']],'scraped_domains',['domain'],update_cols=['lang'])
+        updated += batch.shape[0]
+        print('Detected languages for {} domains. Elapsed time: {}'.format(updated,time.time()-start))
+    return updated
@@ -1,12 +1,31 @@
-import json, base64
+import json, base64, collections
+import numpy as np
 import pandas as pd
+import scipy.sparse as sp
+from scipy.sparse.csgraph import connected_components
 from everest import utils
 import networkx as nx
 import matplotlib.pyplot as plt
 
+LINK_COLUMNS = {
+    'all_ahrefs_domains': 'links_ahrefs_domains',
+    'all_domains': 'links_main_domains',
+    'all_links': 'links',
+}
+
 class Networks:
-    def __init__(self,pg_engine):
+    # The link graph between scraped domains. Domains are given integer ids
+    # (self.nodes) and links kept as deduplicated arrays of source and target
+    # ids, with a CSR adjacency matrix that degrees and weakly connected
+    # components are worked out from. Removed domains stay in the matrix and
+    # are masked out by self.active. A networkx graph is only built when one
+    # is needed: network_graph for the whole graph, or one component's for
+    # drawing. Only the last max_undo removals can be undone.
+    max_undo = 20
+
+    def __init__(self,pg_engine,max_undo=20):
         self.link_type = 'all_ahrefs_domains' #main_domains, #links
+        self.max_undo = max_undo
         self.removed_nodes = []
         print("Pulling domains from db")
         self.pg_engine = pg_engine
@@ -27,100 +46,234 @@ class Networks:
                             sd.links,
                             sd.links_ahrefs_domains, 
                             sd.links_main_domains,
-                            sd.lang,
-                            sd.html
+                            sd.lang
                         FROM domains AS d
                             LEFT JOIN scraped_domains AS sd
                             ON d.referring_domain = sd.domain"""
 
-        network_domains = utils.frame_from_pg(sql_query,self.pg_engine)
+        network_domains = utils.frame_from_pg(sql_query,self.pg_engine,
+                                              parse_dates=['first_seen','last_updated','last_successful_scrape_date'])
         self.all_ahrefs_domains = network_domains.copy()
-        network_domains = network_domains[~network_domains['links'].isnull()]
-        network_domains = network_domains.apply(utils.decode_links,axis=1)
-        self.network_domains = network_domains
+        # link columns stay encoded until a link type needs them
+        self.network_domains = network_domains[~network_domains['links'].isnull()]
+        self.link_lists = {}
+
+    def get_link_lists(self,links_column):
+        if links_column not in self.link_lists:
+            self.link_lists[links_column] = [utils.decode_link_list(value)
+                                             for value in self.network_domains[links_column]]
+        return self.link_lists[links_column]
 
     def reset_network_graph(self):
-        if self.link_type == 'all_ahrefs_domains':
-            links_column = 'links_ahrefs_domains'
-        elif self.link_type == 'all_domains':
-            links_column = 'links_main_domains'
-        elif self.link_type == 'all_links':
-            links_column = 'links'
-        else:
+        if self.link_type not in LINK_COLUMNS:
             raise ValueError("network link_type must be 'all_ahrefs_domains', 'all_domains', or 'all_links'.")
+        link_lists = [links if links and isinstance(links,list) else []
+                      for links in self.get_link_lists(LINK_COLUMNS[self.link_type])]
 
-        G = nx.DiGraph()
-        for index in self.network_domains.index:
-            domain_one = self.network_domains.loc[index,'domain']
-            link_list = self.network_domains.loc[index,links_column]
-            if link_list and isinstance(link_list,list):
-                for domain_two in link_list:
-                    if domain_two != domain_one:
-                        G.add_edge(domain_one,domain_two)
-        self.network_graph = G
-        self.update_network_info()
-        self.removed_nodes = []
+        sources = np.repeat(self.network_domains['domain'].values,[len(links) for links in link_lists])
+        targets = np.array([domain for links in link_lists for domain in links],dtype=object)
+        keep = (sources != targets) & pd.notnull(targets)
+        # ids in order of first appearance, the order networkx would add them
+        codes, nodes = pd.factorize(np.column_stack([sources[keep],targets[keep]]).ravel())
+        n = len(nodes)
+        edges = np.unique(codes[0::2].astype(np.int64)*n + codes[1::2]) if n else np.zeros(0,dtype=np.int64)
 
-    def remove_node(self,node):
-        # G = self.network_graph
-        # G.remove_node(node)
-        self.network_graph.remove_node(node)
-        self.removed_nodes.append(node)
+        self.nodes = pd.Index(nodes)
+        self.sources = edges//max(n,1)
+        self.targets = edges%max(n,1)
+        self.adjacency = sp.csr_matrix((np.ones(len(edges),dtype=np.int8),(self.sources,self.targets)),shape=(n,n))
+        domains = self.all_ahrefs_domains.dropna(subset=['domain']).drop_duplicates('domain').set_index('domain')
+        self.domain_rating = domains['domain_rating'].reindex(self.nodes).values
+        self.organic_traffic = domains['organic_traffic'].reindex(self.nodes).values
+        self.active = np.ones(n,dtype=bool)
+        self.removed_nodes = []
         self.update_network_info()
 
-    def update_network_info(self):
-        G = self.network_graph
-        components = sorted(list(nx.weakly_connected_components(G)),key=len,reverse=True)
-        self.components = components
-
-        domain_info = pd.DataFrame([
-            {'domain': node, 
-            'all_links': G.degree[node],
-            'in_links': G.in_degree[node],
-            'out_links': G.out_degree[node],
-            } 
-            for node in G
-            ]).sort_values('all_links',ascending=False).set_index('domain')
-        domain_info['component'] = None
-
-        component_info = []
-        for index, component in enumerate(components):
-            for domain in component:
-                domain_info.loc[domain,'component'] = index
-            c_info = {
-                'component': index,
-                'size': G.subgraph(component).number_of_nodes(),
-                'links': G.subgraph(component).number_of_edges(),
-                'centroid': max(list(G.degree(component)),key=lambda item:item[1])[0],
-                'centroid_links': max(list(G.degree(component)),key=lambda item:item[1])[1],
-            }
-            c_info['density'] = c_info['links']/c_info['size']
-            c_info['star'] = c_info['links'] ==  c_info['centroid_links']
-            component_info.append(c_info)
-        component_info = pd.DataFrame(component_info).set_index('component')
-
-        domain_info = domain_info.join(
-            self.all_ahrefs_domains.set_index('domain')[['domain_rating','organic_traffic']],
-            how='left'
-        )
+    def summarize(self,nodes):
+        # Degrees and weakly connected components of the graph between the
+        # given node ids, which must be whole components (every link of a
+        # node is then inside it). Cost goes with the size of those
+        # components, not of the graph.
+        sub = self.adjacency[nodes][:,nodes]
+        out_links = np.diff(sub.indptr)
+        in_links = np.bincount(sub.indices,minlength=len(nodes))
+        labels = connected_components(sub,directed=True,connection='weak')[1]
+        edge_rows = np.repeat(np.arange(len(nodes)),out_links)
+        return in_links, out_links, labels, edge_rows
+
+    def domain_rows(self,nodes,component,in_links,out_links):
+        return pd.DataFrame({
+            'domain': self.nodes[nodes],
+            'component': component,
+            'all_links': in_links + out_links,
+            'in_links': in_links,
+            'out_links': out_links,
+            'domain_rating': self.domain_rating[nodes],
+            'organic_traffic': self.organic_traffic[nodes],
+        }).set_index('domain')
+
+    def component_rows(self,nodes,component,in_links,out_links,edge_rows):
+        all_links = in_links + out_links
+        ids, local = np.unique(component,return_inverse=True)
+        n_components = len(ids)
+        # the most linked domain in each component
+        order = np.lexsort((-all_links,local))
+        first = order[np.searchsorted(local[order],np.arange(n_components))]
+        component_info = pd.DataFrame({
+            'component': ids,
+            'size': np.bincount(local,minlength=n_components),
+            'links': np.bincount(local[edge_rows],minlength=n_components),
+            'centroid': self.nodes[nodes[first]],
+            'centroid_links': all_links[first],
+        }).set_index('component')
+        component_info['density'] = component_info['links']/component_info['size']
+        component_info['star'] = component_info['links'] == component_info['centroid_links']
 
+        by_component = pd.DataFrame({
+            'component': component,
+            'domain_rating': self.domain_rating[nodes],
+            'organic_traffic': self.organic_traffic[nodes],
+        }).groupby('component')
         component_info = component_info.join(
-            domain_info.groupby('component').mean().rename(columns={
+            by_component.mean().rename(columns={
                 'domain_rating': 'mean_domain_rating',
                 'organic_traffic': 'mean_organic_traffic'
-            })[['mean_domain_rating','mean_organic_traffic']]
+            })
         ).join(
-            domain_info.groupby('component').max().rename(columns={
+            by_component.max().rename(columns={
                 'domain_rating': 'max_domain_rating',
                 'organic_traffic': 'max_organic_traffic'
-            })[['max_domain_rating','max_organic_traffic']]
+            })
         )
+        return component_info[['size','links','density','star','centroid', 'centroid_links',
+                               'mean_domain_rating', 'mean_organic_traffic', 'max_domain_rating',
+                               'max_organic_traffic']]
+
+    def update_network_info(self):
+        # Everything from scratch, with components numbered largest first
+        # (scipy numbers them in order of their first node, which is kept
+        # between equal sizes). Clears the undo stack, as the numbering
+        # changes.
+        nodes = np.flatnonzero(self.active)
+        in_links, out_links, labels, edge_rows = self.summarize(nodes)
+        sizes = np.bincount(labels)
+        rank = np.empty(len(sizes),dtype=np.int64)
+        rank[np.argsort(-sizes,kind='stable')] = np.arange(len(sizes))
+        self.component = np.full(len(self.nodes),-1)
+        self.component[nodes] = rank[labels]
+        self.next_component = len(sizes)
+        self.undo_stack = collections.deque(maxlen=self.max_undo)
+        self._network_graph = None
+        self.domain_info = self.domain_rows(nodes,rank[labels],in_links,out_links).sort_values(
+            'all_links',ascending=False,kind='stable')
+        self.component_info = self.component_rows(nodes,rank[labels],in_links,out_links,edge_rows).sort_index()
+
+    def remove_node(self,node):
+        self.remove_nodes([node])
+
+    def remove_nodes(self,nodes):
+        # Takes domains out of the network, re-splitting only the components
+        # they were in. Every other component keeps its number and its rows;
+        # a component that was split keeps its number for its largest part,
+        # and the other parts are numbered after the highest so far, so
+        # component_info is no longer in order of size (see ranked_components).
+        # Undo with undo(), which only needs the old component numbers as the
+        # rows are worked out again from them.
+        names = list(nodes)
+        ids = self.nodes.get_indexer(names)
+        missing = [name for name, i in zip(names,ids) if i < 0 or not self.active[i]]
+        if missing:
+            raise KeyError('Not in the network: {}'.format(missing))
+        affected = np.unique(self.component[ids])
+        members = np.flatnonzero(np.isin(self.component,affected))
+        self.undo_stack.append({
+            'nodes': ids,
+            'members': members,
+            'component': self.component[members].copy(),
+            'next_component': self.next_component,
+        })
+        self.active[ids] = False
+        self.component[ids] = -1
+        self.removed_nodes.extend(names)
+
+        nodes = members[self.active[members]]
+        in_links, out_links, labels, edge_rows = self.summarize(nodes)
+        # each part's old component, then the largest part of each first
+        sizes = np.bincount(labels)
+        old = np.empty(len(sizes),dtype=np.int64)
+        old[labels] = self.component[nodes]
+        order = np.lexsort((np.arange(len(sizes)),-sizes,old))
+        keeps = np.r_[True,old[order][1:] != old[order][:-1]] if len(order) else np.zeros(0,dtype=bool)
+        new = np.empty(len(sizes),dtype=np.int64)
+        new[order[keeps]] = old[order[keeps]]
+        new[order[~keeps]] = self.next_component + np.arange((~keeps).sum())
+        self.next_component += int((~keeps).sum())
+        self.component[nodes] = new[labels]
+
+        self.domain_info = pd.concat([
+            self.domain_info.drop(self.nodes[members]),
+            self.domain_rows(nodes,new[labels],in_links,out_links)
+        ]).sort_values('all_links',ascending=False,kind='stable')
+        self.component_info = pd.concat([
+            self.component_info.drop(affected),
+            self.component_rows(nodes,new[labels],in_links,out_links,edge_rows)
+        ]).sort_index()
+        self._network_graph = None
+
+    def undo(self):
+        # Puts back the domains taken out by the last remove_node(s)
+        if not self.undo_stack:
+            raise IndexError('Nothing to undo')
+        record = self.undo_stack.pop()
+        members = record['members']
+        parts = np.unique(self.component[members])
+        self.active[record['nodes']] = True
+        self.component[members] = record['component']
+        self.next_component = record['next_component']
+        del self.removed_nodes[len(self.removed_nodes)-len(record['nodes']):]
+
+        in_links, out_links, labels, edge_rows = self.summarize(members)
+        self.domain_info = pd.concat([
+            self.domain_info.drop(self.nodes[members],errors='ignore'),
+            self.domain_rows(members,record['component'],in_links,out_links)
+        ]).sort_values('all_links',ascending=False,kind='stable')
+        self.component_info = pd.concat([
+            self.component_info.drop(parts[parts >= 0],errors='ignore'),
+            self.component_rows(members,record['component'],in_links,out_links,edge_rows)
+        ]).sort_index()
+        self._network_graph = None
+
+    @property
+    def ranked_components(self):
+        # component_info largest first, as it is before any remove_nodes
+        return self.component_info.sort_values('size',ascending=False,kind='stable')
+
+    @property
+    def components(self):
+        # the domains in each component, by component number (components
+        # emptied by remove_nodes are left as empty sets)
+        nodes = np.flatnonzero(self.active)
+        if self.next_component == 0:
+            return []
+        component = self.component[nodes]
+        order = np.argsort(component,kind='stable')
+        bounds = np.cumsum(np.bincount(component,minlength=self.next_component))[:-1]
+        return [set(domains) for domains in np.split(self.nodes[nodes[order]],bounds)]
+
+    def component_graph(self,component=None):
+        # networkx graph of one component, or of the whole network
+        nodes = self.active if component is None else self.component == component
+        edges = nodes[self.sources] & nodes[self.targets]
+        G = nx.DiGraph()
+        G.add_nodes_from(self.nodes[nodes])
+        G.add_edges_from(zip(self.nodes[self.sources[edges]],self.nodes[self.targets[edges]]))
+        return G
 
-        self.domain_info = domain_info[['component','all_links','in_links', 'out_links', 
-                                        'domain_rating','organic_traffic']]
-        self.component_info = component_info[['size','links','density','star','centroid', 'centroid_links',
-                                        'mean_domain_rating', 'mean_organic_traffic', 'max_domain_rating',
-                                        'max_organic_traffic']]
+    @property
+    def network_graph(self):
+        if self._network_graph is None:
+            self._network_graph = self.component_graph()
+        return self._network_graph
 
     def set_link_type(self,link_type):
         if link_type in ['all_ahrefs_domains','all_domains','all_links']:
@@ -136,12 +289,10 @@ class Networks:
         return self.get_component(self.domain_info.loc[domain,'component'])
 
     def draw_component(self,component,labels=True):
-        G = self.network_graph
-        components = self.components 
         plt.axis('off')
         plt.rcParams['figure.dpi'] = 100
         plt.rcParams['figure.figsize'] = [8, 8]
-        nx.draw_networkx(G.subgraph(components[component]),
+        nx.draw_networkx(self.component_graph(component),
                         with_labels=True,
                         node_size = 20,
                         alpha = 0.5,
@@ -0,0 +1,133 @@
+import os, time, queue, threading, asyncio
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+
+from everest import scrape, utils
+from everest import async_scrape
+
+# Three stage scrape: the async fetcher feeds raw responses through a bounded
+# queue, a pool of worker processes parses them, and a writer thread batches
+# the parsed rows into scraped_domains. Every row holds a slot from the time
+# it leaves the fetch queue until the writer takes it, which bounds memory.
+
+_all_ahrefs_domains = None
+
+def init_parser(all_ahrefs_domains):
+    global _all_ahrefs_domains
+    _all_ahrefs_domains = all_ahrefs_domains
+
+def parse_worker(row,content,dtime):
+    return scrape.parse_response(row,content,_all_ahrefs_domains,dtime)
+
+class Writer(threading.Thread):
+    def __init__(self,pg_engine,write_batch_size,slots,total):
+        threading.Thread.__init__(self,daemon=True)
+        self.pg_engine = pg_engine
+        self.write_batch_size = write_batch_size
+        self.slots = slots
+        self.total = total
+        self.completed = 0
+        self.error = None
+        self.items = queue.Queue()
+        self.start_time = time.time()
+
+    def put(self,item):
+        self.items.put(item)
+
+    def run(self):
+        batch = []
+        try:
+            while True:
+                item = self.items.get()
+                if item is None:
+                    break
+                row, future = item
+                if future is not None:
+                    try:
+                        row = future.result()
+                    except Exception as e:
+                        row['last_scrape_parse_error'] = str(e)
+                batch.append(row)
+                self.slots.release()
+                if len(batch) >= self.write_batch_size:
+                    self.write(batch)
+                    batch = []
+            if batch:
+                self.write(batch)
+        except Exception as e:
+            self.error = e
+
+    def write(self,batch):
+        immediate = pd.DataFrame(batch)
+        scrape.upload_scraped_bisect(self.pg_engine,immediate)
+        self.completed += immediate.shape[0]
+        print('Scraped {} of {} domains. Elapsed time: {}'.format(
+            self.completed,self.total,time.time()-self.start_time))
+
+def stop_fetching(fetching,fetched,stopped):
+    # After the parse/write side has failed: stops new fetches and puts,
+    # cancels those in flight and empties fetched, so nothing is left
+    # blocked on it and the error gets back to the caller
+    stopped.set()
+    fetching.cancel()
+    while True:
+        try:
+            fetched.get_nowait()
+        except queue.Empty:
+            break
+
+def scrape_pipeline(pg_engine,time_limit=2,scrape_condition='WHERE last_scrape_date IS NULL',
+                    concurrency=100,per_host=2,race=False,parse_workers=None,
+                    queue_size=500,write_batch_size=100):
+    all_ahrefs_domains = utils.get_domain_index(pg_engine)
+    scraped_domains = scrape.get_domains_to_scrape(pg_engine,scrape_condition)
+
+    if scraped_domains.shape[0] == 0:
+        print('Nothing to scrape')
+        return
+
+    parse_workers = parse_workers or os.cpu_count()
+    fetched = queue.Queue(maxsize=queue_size)
+    slots = threading.BoundedSemaphore(queue_size)
+    writer = Writer(pg_engine,write_batch_size,slots,scraped_domains.shape[0])
+    writer.start()
+
+    scraper = async_scrape.AsyncScraper(time_limit,concurrency,per_host,race=race)
+    pool = ProcessPoolExecutor(max_workers=parse_workers,
+                               initializer=init_parser,
+                               initargs=(all_ahrefs_domains,))
+    stopped = threading.Event()
+    fetching = None
+    try:
+        rows = [row.copy() for _, row in scraped_domains.iterrows()]
+        del scraped_domains
+        fetching = asyncio.run_coroutine_threadsafe(scraper.fetch_to_queue(rows,fetched,stopped),scraper.loop)
+        fetching.add_done_callback(lambda f: async_scrape.put_until_stopped(fetched,None,stopped))
+
+        while True:
+            item = fetched.get()
+            if item is None:
+                break
+            if writer.error:
+                raise writer.error
+            row, status, content, dtime = item
+            while not slots.acquire(timeout=1):
+                if writer.error:
+                    raise writer.error
+            if status == 200:
+                future = pool.submit(parse_worker,row,content,dtime)
+                future.add_done_callback(lambda f,row=row: writer.put((row,f)))
+            else:
+                writer.put((row,None))
+        fetching.result()
+    except BaseException:
+        if fetching is not None:
+            stop_fetching(fetching,fetched,stopped)
+        raise
+    finally:
+        pool.shutdown(wait=True)
+        scraper.close()
+        writer.put(None)
+        writer.join()
+    if writer.error:
+        raise writer.error
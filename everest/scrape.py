@@ -1,14 +1,13 @@
-import re, json, base64
+import re
 import datetime, time
 import pandas as pd
 import numpy as np
 import requests
 
 from langdetect import detect
-from bs4 import BeautifulSoup
 from bs4.element import Comment
 
-from everest import utils
+from everest import utils, extract, cache
 
 def tag_visible(element):
     if element.parent.name in ['style', 'script', 'head', 'title', 'meta', '[document]']:
@@ -25,7 +24,7 @@ def text_from_html(soup):
     string = re.sub(' +',' ',string).strip()
     return string
 
-def get_page_text(soup,domain):
+def get_page_text(soup,domain,detect_lang=True):
     try:
         title = soup.find('title')
         if title:
@@ -51,10 +50,12 @@ def get_page_text(soup,domain):
                 main = text_from_html(main)
         a_tags = soup.findAll('a', attrs={'href': re.compile("^https?://")})
         links = [a_tag.get('href') for a_tag in a_tags if domain not in a_tag.get('href')]
-        try:
-            lang = detect(main)
-        except:
-            lang = "Can't detect language - no text, or langdetect not installed"
+        lang = None
+        if detect_lang:
+            try:
+                lang = detect(main)
+            except:
+                lang = "Can't detect language - no text, or langdetect not installed"
 #         return title, body, header, footer, main, links, lang, None
         return title, main, links, lang, None
     except Exception as e:
@@ -62,20 +63,67 @@ def get_page_text(soup,domain):
 #         return None, None, None, None, None, None, None, str(e)
 
 
-def scrape_domain(row,all_ahrefs_domains,time_limit):       
+def get_urls_to_try(row):
+    # Candidate urls, most likely first: each variant is scored by the share
+    # of the domain's backlinks using that protocol and www prefix. A url that
+    # returned 200 on a previous scrape goes ahead of everything else.
     domain = row['domain']
-    urls_to_try = []
+    total = max(row['total_backlinks'],1)
+    p_https = row['url_https']/total
+    p_www = row['url_www']/total
+    candidates = []
     protocols = []
     if row['url_https'] > 0:
-        protocols.append('https://')
+        protocols.append(('https://',p_https))
     if row['url_https'] < row['total_backlinks']:
-        protocols.append('http://')
+        protocols.append(('http://',1-p_https))
     if row['url_www'] > 0:
-        for protocol in protocols:
-            urls_to_try.append('{}www.{}'.format(protocol,domain))
+        for protocol, p in protocols:
+            candidates.append(('{}www.{}'.format(protocol,domain),p*p_www))
     if row['url_www'] < row['total_backlinks']:
-        for protocol in protocols:
-            urls_to_try.append('{}{}'.format(protocol,domain))
+        for protocol, p in protocols:
+            candidates.append(('{}{}'.format(protocol,domain),p*(1-p_www)))
+    urls_to_try = [url for url, p in sorted(candidates,key=lambda item:item[1],reverse=True)]
+
+    last_scrape_url = row.get('last_scrape_url')
+    if isinstance(last_scrape_url,str) and last_scrape_url:
+        urls_to_try = [last_scrape_url] + [x for x in urls_to_try if x != last_scrape_url]
+    return urls_to_try
+
+def parse_response(row,content,all_ahrefs_domains,dtime,parser='lxml'):
+    domain = row['domain']
+    try:
+        title, main, links, lang, last_scrape_parse_error = extract.extract_page(content, domain, parser)
+#             title, body, header, footer, main, links, lang, last_scrape_parse_error = get_page_text(soup, domain)
+        row['last_scrape_parse_error'] = last_scrape_parse_error
+        
+        if links:
+            links_main_domains = list(set([utils.get_url_main(a_tag) for a_tag in links]))
+        else:
+            links_main_domains = []
+            links = []
+        if links_main_domains:
+            links_ahrefs_domains = list(set([match for match, error in all_ahrefs_domains.match_many(links_main_domains)]))
+            links_ahrefs_domains = [x for x in links_ahrefs_domains if x]
+        else:
+            links_ahrefs_domains = []
+#             row['title'] = base64.b64encode(title).decode('utf-8')
+#             row['body'] = body
+#             row['header'] = header
+#             row['footer'] = footer
+        row['lang'] = lang
+        row['last_successful_scrape_date'] = dtime
+        row['html'] = utils.encode_bytea(content)
+        row['main'] = utils.encode_bytea(main.encode('utf-8'))
+        row['links'] = utils.encode_link_list(links)
+        row['links_main_domains'] = utils.encode_link_list(links_main_domains)
+        row['links_ahrefs_domains'] = utils.encode_link_list(links_ahrefs_domains)
+    except Exception as e:
+        row['last_scrape_parse_error'] = str(e)
+    return row
+
+def scrape_domain(row,all_ahrefs_domains,time_limit):       
+    urls_to_try = get_urls_to_try(row)
                         
     r = None
     for url in urls_to_try:      
@@ -85,54 +133,107 @@ def scrape_domain(row,all_ahrefs_domains,time_limit):
             r = requests.get(url,timeout=time_limit)
             row['last_scrape_request_error'] = None
             row['last_scrape_code'] = r.status_code
-#             if r.status_code == 200:
-#                 with open('Scraping/Scraped Domains/More/{}.pkl'.format(row.name),'wb') as f:
-#                     pickle.dump(r,f)
-#                 break
+            if r.status_code == 200:
+                row['last_scrape_url'] = url
+                break
         except Exception as e:
             row['last_scrape_code'] = None
             row['last_scrape_request_error'] = str(e)
     
     if r and r.status_code == 200:
-        try:
-            soup = BeautifulSoup(r.content)
-            title, main, links, lang, last_scrape_parse_error = get_page_text(soup, domain)
-#             title, body, header, footer, main, links, lang, last_scrape_parse_error = get_page_text(soup, domain)
-            row['last_scrape_parse_error'] = last_scrape_parse_error
-            
-            if links:
-                links_main_domains = list(set([utils.get_url_main(a_tag) for a_tag in links]))
-            else:
-                links_main_domains = []
-                links = []
-            if links_main_domains:
-                links_ahrefs_domains = list(set([utils.get_matching_domain(a_tag,all_ahrefs_domains)[0] for a_tag in links_main_domains]))
-                links_ahrefs_domains = [x for x in links_ahrefs_domains if x]
-            else:
-                links_ahrefs_domains = []
-#             row['title'] = base64.b64encode(title).decode('utf-8')
-#             row['body'] = body
-#             row['header'] = header
-#             row['footer'] = footer
-            row['lang'] = lang
-            row['last_successful_scrape_date'] = dtime
-            row['html'] = base64.b64encode(r.content).decode('utf-8')
-            row['main'] = base64.b64encode(main).decode('utf-8')
-            row['links'] = base64.b64encode(json.dumps(links).encode('utf-8')).decode('utf-8')
-            row['links_main_domains'] = base64.b64encode(json.dumps(links_main_domains).encode('utf-8')).decode('utf-8')
-            row['links_ahrefs_domains'] = base64.b64encode(json.dumps(links_ahrefs_domains).encode('utf-8')).decode('utf-8')
-        except Exception as e:
-            row['last_scrape_parse_error'] = str(e)
+        row = parse_response(row,r.content,all_ahrefs_domains,dtime)
     return row
 
-def scrape_batch(pg_engine,time_limit,batch_size,scrape_condition):
-    all_ahrefs_domains = utils.get_all_ahrefs_domains(pg_engine)
+FAILURE_UPDATE_COLS = ['domain','last_scrape_code','last_scrape_date','last_scrape_parse_error','last_scrape_request_error']
+ENCODED_COLS = ['html','main','links','links_main_domains','links_ahrefs_domains']
 
+def get_domains_to_scrape(pg_engine,scrape_condition):
+    utils.add_columns(pg_engine,'scraped_domains',{'last_scrape_url': 'TEXT'})
     sql_query = """SELECT * 
                  FROM scraped_domains 
                 {}
              ORDER BY first_seen DESC""".format(scrape_condition)
-    scraped_domains = utils.frame_from_pg(sql_query,pg_engine)
+    return utils.frame_from_pg(sql_query,pg_engine)
+
+def upload_scraped(pg_engine,immediate):
+    # for col in ['title','main']:
+    #     immediate[col] = immediate[col].astype(str)
+    #     immediate[col] = immediate[col].str.replace("\\","\\\\").str.replace('"','\"')
+
+    immediate = utils.clean_copy_strings(immediate.copy(),
+        [col for col in immediate.columns if col not in ENCODED_COLS])
+
+    immediate_success = immediate[immediate['last_scrape_date']==immediate['last_successful_scrape_date']]
+    immediate_failure = immediate[immediate['last_scrape_date']!=immediate['last_successful_scrape_date']]
+
+    utils.update_pg_table(pg_engine,
+        immediate_success,
+        'scraped_domains',
+        ['domain'],
+        update_cols = 'all'
+        )
+
+    utils.update_pg_table(pg_engine,
+        immediate_failure,
+        'scraped_domains',
+        ['domain'],
+        update_cols = FAILURE_UPDATE_COLS
+        )
+
+def upload_failed_row(pg_engine,immediate):
+    immediate = utils.clean_copy_strings(immediate,
+        [col for col in immediate.columns if col not in ENCODED_COLS])
+    immediate['soup'] = None
+    immediate['title'] = None
+    immediate['main'] = None
+    immediate['links'] = None
+    immediate['links_main_domains'] = None
+    immediate['links_ahrefs_domains'] = None
+    immediate['last_scrape_parse_error'] = 'Scraped nonutf8 characters failed pg upload.'
+    first_ind = immediate.index[0]
+    if not immediate.loc[first_ind,'last_scrape_code']:
+        immediate.loc[first_ind,'last_scrape_code'] = 0
+        immediate['last_scrape_code'] = immediate['last_scrape_code'].astype(int)
+        immediate.loc[first_ind,'last_scrape_code'] = np.nan
+    utils.update_pg_table(pg_engine,
+        immediate[FAILURE_UPDATE_COLS],
+        'scraped_domains',
+        ['domain'],
+        update_cols = FAILURE_UPDATE_COLS
+    )
+
+def upload_scraped_bisect(pg_engine,immediate):
+    # Halves a batch that fails to upload until the offending rows are
+    # isolated, so only those lose their page data.
+    try:
+        upload_scraped(pg_engine,immediate)
+    except Exception as e:
+        if immediate.shape[0] == 1:
+            upload_failed_row(pg_engine,immediate.copy())
+        else:
+            half = immediate.shape[0]//2
+            upload_scraped_bisect(pg_engine,immediate.iloc[:half])
+            upload_scraped_bisect(pg_engine,immediate.iloc[half:])
+
+def scrape_cached(immediate,scrape_rows,cache,since):
+    # Rows fetched since 'since' come from the cache, the rest are scraped
+    # by scrape_rows and cached.
+    cached = [cache.get(domain,since) for domain in immediate['domain']]
+    to_scrape = immediate[[row is None for row in cached]]
+    cached = [row for row in cached if row is not None]
+    if to_scrape.shape[0] > 0:
+        fetch_time = datetime.datetime.now()
+        to_scrape = scrape_rows(to_scrape)
+        for index in to_scrape.index:
+            cache.put(to_scrape.loc[index,'domain'],fetch_time,to_scrape.loc[index])
+    if cached:
+        return pd.concat([to_scrape,pd.DataFrame(cached)],sort=False)
+    return to_scrape
+
+def scrape_batch(pg_engine,time_limit,batch_size,scrape_condition,scraper=None,
+                 cache=None,cache_since=None,bisect_failures=True):
+    all_ahrefs_domains = utils.get_domain_index(pg_engine)
+    scraped_domains = get_domains_to_scrape(pg_engine,scrape_condition)
 
     if scraped_domains.shape[0] == 0:
         print('Nothing to scrape')
@@ -146,60 +247,75 @@ def scrape_batch(pg_engine,time_limit,batch_size,scrape_condition):
         immediate = scraped_domains.head(batch_size)
         scraped_domains = scraped_domains[~scraped_domains.index.isin(immediate.index)]
 
-        immediate = immediate.apply(scrape_domain,axis=1,args=(all_ahrefs_domains,time_limit,))
-
-        # for col in ['title','main']:
-        #     immediate[col] = immediate[col].astype(str)
-        #     immediate[col] = immediate[col].str.replace("\\","\\\\").str.replace('"','\"')
-
-        immediate_success = immediate[immediate['last_scrape_date']==immediate['last_successful_scrape_date']]
-        immediate_failure = immediate[immediate['last_scrape_date']!=immediate['last_successful_scrape_date']]
-
-        try:
-            utils.update_pg_table(pg_engine,
-                immediate_success,
-                'scraped_domains',
-                ['domain'],
-                update_cols = 'all'
-                )
-
-            utils.update_pg_table(pg_engine,
-                immediate_failure,
-                'scraped_domains',
-                ['domain'],
-                update_cols = ['domain','last_scrape_code','last_scrape_date','last_scrape_parse_error','last_scrape_request_error']
-                )
+        if scraper:
+            scrape_rows = lambda df: scraper.scrape_frame(df,all_ahrefs_domains)
+        else:
+            scrape_rows = lambda df: df.apply(scrape_domain,axis=1,args=(all_ahrefs_domains,time_limit,))
+        if cache:
+            immediate = scrape_cached(immediate,scrape_rows,cache,cache_since)
+        else:
+            immediate = scrape_rows(immediate)
 
+        if bisect_failures:
+            upload_scraped_bisect(pg_engine,immediate)
             completed += immediate.shape[0]
-        except Exception as e:
-            if batch_size == 1:
-                immediate['soup'] = None
-                immediate['title'] = None
-                immediate['main'] = None
-                immediate['links'] = None
-                immediate['links_main_domains'] = None
-                immediate['links_ahrefs_domains'] = None
-                immediate['last_scrape_parse_error'] = 'Scraped nonutf8 characters failed pg upload.'
-                first_ind = immediate.index[0]
-                if not immediate.loc[first_ind,'last_scrape_code']:
-                    immediate.loc[first_ind,'last_scrape_code'] = 0
-                    immediate['last_scrape_code'] = immediate['last_scrape_code'].astype(int)
-                    immediate.loc[first_ind,'last_scrape_code'] = np.nan
-                utils.update_pg_table(pg_engine,
-                    immediate,
-                    'scraped_domains',
-                    ['domain'],
-                    update_cols = ['domain','last_scrape_code','last_scrape_date','last_scrape_parse_error','last_scrape_request_error']
-                )
+        else:
+            try:
+                upload_scraped(pg_engine,immediate)
+                completed += immediate.shape[0]
+            except Exception as e:
+                if batch_size == 1:
+                    upload_failed_row(pg_engine,immediate)
 
         print('Scraped {} of {} domains. {} remaining. Elapsed time: {}'.format(
             completed,total,scraped_domains.shape[0],time.time()-start))
     
-def scrape(pg_engine,time_limit=2,scrape_condition='WHERE last_scrape_date IS NULL'):
-    print('-----------Scraping First Pass----------')
-    scrape_batch(pg_engine,time_limit,100,scrape_condition)
-    print('-----------Scraping Second Pass----------')
-    scrape_batch(pg_engine,time_limit,10,scrape_condition)
-    print('-----------Scraping Third Pass----------')
-    scrape_batch(pg_engine,time_limit,1,scrape_condition)
+def scrape(pg_engine,time_limit=2,scrape_condition='WHERE last_scrape_date IS NULL',
+           mode='sync',batch_sizes=(100,10,1),concurrency=100,per_host=2,race=False,
+           parse_workers=None,bisect_failures=True,cache_dir=None,cache_max_bytes=1024**3,
+           cache_max_age=None,queue=False):
+    # Each pass only picks up rows that earlier passes failed to upload. Those
+    # are served from a response cache rather than fetched again: a temporary
+    # one for this run unless cache_dir is given, in which case entries up to
+    # cache_max_age seconds old are reused across runs.
+    # With queue=True the domains are put on the shared work queue and this
+    # process works through it alongside any other workqueue.run_worker.
+    if queue:
+        from everest import workqueue
+        if mode not in workqueue.WORKER_MODES:
+            raise ValueError("queue mode must be 'sync' or 'async'.")
+        print('-----------Scraping Work Queue----------')
+        workqueue.enqueue(pg_engine,scrape_condition)
+        workqueue.run_worker(pg_engine,time_limit=time_limit,mode=mode,
+            concurrency=concurrency,per_host=per_host,race=race)
+        print('---------Scraping Complete----------')
+        return
+    if mode == 'pipeline':
+        from everest import pipeline
+        print('-----------Scraping Pipeline----------')
+        pipeline.scrape_pipeline(pg_engine,time_limit,scrape_condition,
+            concurrency=concurrency,per_host=per_host,race=race,parse_workers=parse_workers)
+        print('---------Scraping Complete----------')
+        return
+    if mode == 'async':
+        from everest import async_scrape
+        scraper = async_scrape.AsyncScraper(time_limit,concurrency,per_host,race=race)
+    elif mode == 'sync':
+        scraper = None
+    else:
+        raise ValueError("scrape mode must be 'sync', 'async' or 'pipeline'.")
+    response_cache = cache.ResponseCache(cache_dir,cache_max_bytes)
+    if cache_max_age is not None:
+        cache_since = datetime.datetime.now()-datetime.timedelta(seconds=cache_max_age)
+    else:
+        cache_since = datetime.datetime.now()
+    try:
+        for index, batch_size in enumerate(batch_sizes):
+            print('-----------Scraping Pass {} (batch size {})----------'.format(index+1,batch_size))
+            scrape_batch(pg_engine,time_limit,batch_size,scrape_condition,scraper,
+                         response_cache,cache_since,bisect_failures)
+    finally:
+        if scraper:
+            scraper.close()
+        response_cache.close()
     print('---------Scraping Complete----------')
@@ -0,0 +1,82 @@
+import asyncio, random, socket, threading
+from aiohttp import web
+from aiohttp.abc import AbstractResolver
+
+WORDS = ['backlink','network','domain','cluster','market','review','guide','casino','loan','travel',
+         'health','crypto','games','fashion','finance','sports','recipes','hosting','software','music']
+
+def make_page(site,n_words=300,n_links=20,seed=None):
+    # Deterministic synthetic page for a site name, with a title, header,
+    # footer, body text and a mix of internal and outbound links.
+    rng = random.Random(seed if seed is not None else site)
+    text = ' '.join(rng.choice(WORDS) for _ in range(n_words))
+    links = ''.join(
+        '<a href="http://site{}.test/page">link</a>\n'.format(rng.randrange(10000))
+        for _ in range(n_links)
+    )
+    return """<!DOCTYPE html>
+<html><head><title>{site} | {title}</title><script>var x = 1;</script></head>
+<body><header><a href="https://{site}/">home</a> menu</header>
+<p>{text}</p>
+<!-- comment -->
+{links}
+<footer>copyright {site}</footer></body></html>""".format(
+        site=site,title=rng.choice(WORDS),text=text,links=links)
+
+class LocalResolver(AbstractResolver):
+    # Resolves every hostname to the local test server, so the scraper's
+    # per-host limits still see distinct hosts without any DNS or network.
+    def __init__(self,port):
+        self.port = port
+
+    async def resolve(self,host,port=0,family=socket.AF_INET):
+        return [{'hostname': host,
+                 'host': '127.0.0.1',
+                 'port': self.port,
+                 'family': socket.AF_INET,
+                 'proto': 0,
+                 'flags': socket.AI_NUMERICHOST}]
+
+    async def close(self):
+        pass
+
+class TestServer:
+    # Serves make_page() for whichever site is asked for, either by Host
+    # header or as the first path segment, with optional simulated latency.
+    def __init__(self,port=8765,latency=0,n_words=300,n_links=20):
+        self.port = port
+        self.latency = latency
+        self.n_words = n_words
+        self.n_links = n_links
+        self.requests = 0
+        self.loop = asyncio.new_event_loop()
+        self.thread = None
+
+    async def handle(self,request):
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        site = request.match_info.get('site') or request.host.split(':')[0]
+        return web.Response(text=make_page(site,self.n_words,self.n_links),content_type='text/html')
+
+    async def setup(self):
+        app = web.Application()
+        app.router.add_get('/',self.handle)
+        app.router.add_get('/{site}',self.handle)
+        app.router.add_get('/{site}/{path:.*}',self.handle)
+        self.runner = web.AppRunner(app,access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner,'127.0.0.1',self.port,backlog=1024)
+        await site.start()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.loop.run_forever,daemon=True)
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self.setup(),self.loop).result()
+        return self
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self.runner.cleanup(),self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
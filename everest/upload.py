@@ -33,151 +33,206 @@ def get_link_type(row):
         return('Error finding link type - {}'.format(e))
 
 
-def update_domain_matches(pg_engine):
-    sql_query = 'SELECT DISTINCT referring_domain FROM domains'
-    domains = utils.frame_from_pg(sql_query, pg_engine)
-    all_domains = set(domains['referring_domain'])
-
-    sql_query = 'SELECT DISTINCT referring_page_url FROM backlinks'
-    backlink_urls = utils.frame_from_pg(sql_query, pg_engine)
-
-    (
-        backlink_urls['url_https'],
-        backlink_urls['url_www'],
-        backlink_urls['url_main'], 
-        backlink_urls['url_path'],
-        backlink_urls['url_params'],
-        backlink_urls['error_in_split_url']
-    ) = zip(
-        *backlink_urls['referring_page_url'].apply(utils.split_url)
-    )
-
-    url_main_domain_matches = backlink_urls[['url_main']].drop_duplicates()
-    (
-        url_main_domain_matches['matching_ahrefs_domain'], 
-        url_main_domain_matches['error_in_get_matching_domain']
-    ) = zip(
-        *url_main_domain_matches['url_main'].apply(utils.get_matching_domain,args=[all_domains])
-    )
-    url_main_domain_matches = url_main_domain_matches[
-        ['url_main','matching_ahrefs_domain','error_in_get_matching_domain']
-    ]
-
-    utils.frame_to_pg(pg_engine,
-                url_main_domain_matches,
-                'url_main_domain_matches',
-                ['url_main']
-            )
+def match_url_mains(domain_index,url_mains):
+    url_main_domain_matches = pd.DataFrame({'url_main': url_mains})
+    matches = domain_index.match_many(url_main_domain_matches['url_main'])
+    url_main_domain_matches['matching_ahrefs_domain'] = [match for match, error in matches]
+    url_main_domain_matches['error_in_get_matching_domain'] = [error for match, error in matches]
+    return url_main_domain_matches
+
+def table_exists(pg_engine,table_name):
+    exists = utils.frame_from_pg("""SELECT to_regclass('{}') IS NOT NULL AS e""".format(table_name),pg_engine)
+    return bool(exists['e'].iloc[0] in (True,'t'))
+
+def prepare_domain_matches(pg_engine):
+    # matched_domains records which domains url_main_domain_matches has been
+    # matched against. The reversed url_main index lets the url_mains under
+    # a new domain be found with a range scan.
+    conn = pg_engine.connect()
+    conn.execute("""CREATE TABLE IF NOT EXISTS matched_domains (domain TEXT PRIMARY KEY)""")
+    conn.execute("""CREATE INDEX IF NOT EXISTS url_main_domain_matches_reversed
+                    ON url_main_domain_matches ((reverse(url_main) COLLATE "C"))""")
+    conn.close()
+
+def prepare_backlink_indexes(pg_engine):
+    # What pulling one cluster's backlinks (cluster.Clusters) joins on.
+    # Built here rather than when the results are read, since building the
+    # backlinks index takes a while on a large table and needs owner rights.
+    conn = pg_engine.connect()
+    conn.execute("""CREATE INDEX IF NOT EXISTS url_main_domain_matches_domain
+                    ON url_main_domain_matches (matching_ahrefs_domain)""")
+    conn.execute("""CREATE INDEX IF NOT EXISTS backlinks_url_main ON backlinks (url_main)""")
+    conn.close()
+
+def record_matched_domains(pg_engine,rebuild=False):
+    conn = pg_engine.connect()
+    if rebuild:
+        conn.execute("""TRUNCATE matched_domains""")
+    conn.execute("""INSERT INTO matched_domains (domain)
+                    SELECT referring_domain FROM domains WHERE referring_domain IS NOT NULL
+                    ON CONFLICT DO NOTHING""")
+    conn.close()
+
+def update_domain_matches(pg_engine,full_rebuild=False):
+    # Only url_mains that aren't in url_main_domain_matches yet, and those
+    # whose match could change because a domain arrived that they haven't
+    # been matched against (the domain itself or anything under it), are
+    # matched and upserted. full_rebuild rematches every backlink url from
+    # scratch, which is also what happens the first time.
+    domain_index = utils.get_domain_index(pg_engine,refresh=True)
+
+    if (full_rebuild
+        or not table_exists(pg_engine,'url_main_domain_matches')
+        or not table_exists(pg_engine,'matched_domains')):
+        sql_query = 'SELECT DISTINCT referring_page_url FROM backlinks'
+        backlink_urls = utils.frame_from_pg(sql_query, pg_engine)
+        backlink_urls = backlink_urls.join(utils.split_urls(backlink_urls['referring_page_url']))
+        url_main_domain_matches = match_url_mains(domain_index,backlink_urls['url_main'].drop_duplicates())
+
+        utils.frame_to_pg(pg_engine,
+                    url_main_domain_matches,
+                    'url_main_domain_matches',
+                    ['url_main']
+                )
+        prepare_domain_matches(pg_engine)
+        prepare_backlink_indexes(pg_engine)
+        record_matched_domains(pg_engine,rebuild=True)
+        print('Matched {} url mains'.format(url_main_domain_matches.shape[0]))
+        return
+
+    sql_query = """SELECT DISTINCT b.url_main
+                     FROM backlinks AS b
+                LEFT JOIN url_main_domain_matches AS m ON m.url_main = b.url_main
+                    WHERE b.url_main IS NOT NULL AND m.url_main IS NULL
+                    UNION
+                   SELECT m.url_main
+                     FROM (SELECT reverse(d.referring_domain) COLLATE "C" AS reversed_domain
+                             FROM domains AS d
+                        LEFT JOIN matched_domains AS md ON md.domain = d.referring_domain
+                            WHERE md.domain IS NULL AND d.referring_domain IS NOT NULL) AS n
+                     JOIN url_main_domain_matches AS m
+                       ON reverse(m.url_main) COLLATE "C" >= n.reversed_domain
+                          AND reverse(m.url_main) COLLATE "C" < n.reversed_domain || '/'"""
+    url_mains = utils.frame_from_pg(sql_query, pg_engine)
+    if url_mains.shape[0] > 0:
+        url_main_domain_matches = match_url_mains(domain_index,url_mains['url_main'])
+        utils.update_pg_table(pg_engine,
+                    url_main_domain_matches,
+                    'url_main_domain_matches',
+                    ['url_main'],
+                    'all'
+                )
+    prepare_backlink_indexes(pg_engine)
+    record_matched_domains(pg_engine)
+    print('Matched {} new or affected url mains'.format(url_mains.shape[0]))
 
 
 def update_domains_to_scrape(pg_engine):
-    sql_query = """SELECT referring_page_url, backlink_status, first_seen FROM backlinks WHERE link_type IN ('email','formcode')"""
-    backlinks_forms = utils.frame_from_pg(sql_query,pg_engine)
-    sql_query = """SELECT * FROM url_main_domain_matches"""
-    url_main_domain_matches = utils.frame_from_pg(sql_query,pg_engine)
-
-    (
-    backlinks_forms['url_https'],
-    backlinks_forms['url_www'],
-    backlinks_forms['url_main'], 
-    backlinks_forms['url_path'],
-    backlinks_forms['url_params'],
-    backlinks_forms['error_in_split_url']
-    ) = zip(
-        *backlinks_forms['referring_page_url'].apply(utils.split_url)
-    )
-
-    backlinks_forms = pd.merge(
-        backlinks_forms,
-        url_main_domain_matches,
-        how='left',
-        on='url_main'
-    )
-
-    backlinks_forms['total_backlinks'] = 1
-    backlinks_forms['live_backlinks'] = 1*backlinks_forms['backlink_status'].isnull()
-    backlinks_forms['url_www'] = 1*(backlinks_forms['url_www'] == 'www.')
-    backlinks_forms['url_https'] = 1*(backlinks_forms['url_https'] == 'https://')
-
-    backlinks_domains = pd.merge(
-        backlinks_forms[['matching_ahrefs_domain','total_backlinks','live_backlinks','url_www','url_https']].groupby('matching_ahrefs_domain').sum(),
-        backlinks_forms[['matching_ahrefs_domain','first_seen']].groupby('matching_ahrefs_domain').min().reset_index(),
-        on='matching_ahrefs_domain',
-        how='inner'
-    ).rename(columns={'matching_ahrefs_domain': 'domain'})
-
-    utils.update_pg_table(pg_engine,
-                    backlinks_domains,
-                    'scraped_domains',
-                    ['domain'],
-                    update_cols = ['total_backlinks','live_backlinks','url_www','url_https']
-                    )
-
-def upload_ahrefs_data(
-    backlinks_file,
-    domains_file,
-    pg_engine
-    ):
-    print('Loading from CSV')
-    backlinks = pd.read_csv(backlinks_file,
-                            encoding='utf-16',
-                            sep='\t')
-    domains = pd.read_csv(domains_file,
-                            encoding='utf-16',
-                            sep='\t')
-
-    print('Cleaning and processing tables')
+    # Counts email/formcode backlinks per matched domain in postgres and
+    # upserts them into scraped_domains. first_seen is only set for domains
+    # new to scraped_domains. url_https/url_www count urls whose first scheme
+    # is https:// and is followed by www., as split_url reads them.
+    column_types = utils.get_column_types(pg_engine,'scraped_domains')
+    conn = pg_engine.connect()
+    conn.execute("""INSERT INTO scraped_domains (domain, total_backlinks, live_backlinks, url_www, url_https, first_seen)
+                    SELECT m.matching_ahrefs_domain,
+                           {},
+                           {},
+                           {},
+                           {},
+                           {}
+                      FROM backlinks AS b
+                      JOIN url_main_domain_matches AS m ON m.url_main = b.url_main
+                     WHERE b.link_type IN ('email','formcode')
+                           AND m.matching_ahrefs_domain IS NOT NULL
+                  GROUP BY m.matching_ahrefs_domain
+               ON CONFLICT (domain) DO UPDATE
+                       SET total_backlinks = EXCLUDED.total_backlinks,
+                           live_backlinks = EXCLUDED.live_backlinks,
+                           url_www = EXCLUDED.url_www,
+                           url_https = EXCLUDED.url_https""".format(
+        utils.cast_column('COUNT(*)',column_types['total_backlinks']),
+        utils.cast_column('COUNT(*) FILTER (WHERE b.backlink_status IS NULL)',column_types['live_backlinks']),
+        utils.cast_column("COUNT(*) FILTER (WHERE substring(b.referring_page_url from 'https?://(www\\.)?') = 'www.')",
+                          column_types['url_www']),
+        utils.cast_column("COUNT(*) FILTER (WHERE substring(b.referring_page_url from 'https?://') = 'https://')",
+                          column_types['url_https']),
+        utils.cast_column('MIN(b.first_seen)',column_types['first_seen'])))
+    conn.close()
+
+def transform_backlinks(backlinks,update_time):
     rename_columns(backlinks)
-    rename_columns(domains)
-
-    backlinks['referring_page_url'] = backlinks['referring_page_url'].apply(utils.clean_link_strings)
-    backlinks['link_url'] = backlinks['link_url'].apply(utils.clean_link_strings)
-
     backlinks['first_seen'] = pd.to_datetime(backlinks['first_seen'])
     backlinks['last_check'] = pd.to_datetime(backlinks['last_check'])
     backlinks['day_lost'] = pd.to_datetime(backlinks['day_lost'])
     backlinks['live'] = backlinks['backlink_status'].isnull()
     backlinks['link_type'] = backlinks.apply(get_link_type,axis=1)
+    backlinks['last_updated'] = update_time
+    backlinks.drop(columns=['#'],inplace=True)
+    backlinks['url_main'] = utils.split_urls(backlinks['referring_page_url'])['url_main']
+    return backlinks
 
+def transform_domains(domains,update_time):
+    rename_columns(domains)
     domains['first_seen'] = pd.to_datetime(domains['first_seen'])
-
-    update_time = datetime.datetime.now()
-    backlinks['last_updated'] = update_time
     domains['last_updated'] = update_time
-
-    backlinks.drop(columns=['#'],inplace=True)
     domains.drop(columns=['#'],inplace=True)
+    return domains
+
+def read_export(export_file,chunksize=None):
+    return pd.read_csv(export_file,
+                       encoding='utf-16',
+                       sep='\t',
+                       chunksize=chunksize)
 
-    (
-        backlinks['url_https'],
-        backlinks['url_www'],
-        backlinks['url_main'], 
-        backlinks['url_path'],
-        backlinks['url_params'],
-        backlinks['error_in_split_url']
-    ) = zip(
-        *backlinks['referring_page_url'].apply(utils.split_url)
-    )
-    backlinks.drop(columns=['url_https',
-                            'url_www',
-                            'url_path',
-                            'url_params',
-                            'error_in_split_url'],inplace=True)
-
-    print('Uploading backlinks to postgres')
-    utils.update_pg_table(pg_engine,
-        backlinks,
-        'backlinks',
-        ['referring_page_url', 'link_url', 'first_seen'],
-        'all'
-    )
-    print('Uploading domains to postgres')
-    utils.update_pg_table(pg_engine,
-        domains,
-        'domains',
-        ['referring_domain'],
-        'all'
-    )
+def upload_ahrefs_data(
+    backlinks_file,
+    domains_file,
+    pg_engine,
+    chunksize=None
+    ):
+    # With chunksize, the exports are read, transformed and copied to
+    # postgres that many rows at a time, so memory use doesn't grow with the
+    # size of the export. The tables end up the same either way.
+    update_time = datetime.datetime.now()
+    if chunksize:
+        print('Streaming backlinks to postgres')
+        utils.stream_update_pg_table(pg_engine,
+            (transform_backlinks(chunk,update_time) for chunk in read_export(backlinks_file,chunksize)),
+            'backlinks',
+            ['referring_page_url', 'link_url', 'first_seen'],
+            'all'
+        )
+        print('Streaming domains to postgres')
+        utils.stream_update_pg_table(pg_engine,
+            (transform_domains(chunk,update_time) for chunk in read_export(domains_file,chunksize)),
+            'domains',
+            ['referring_domain'],
+            'all'
+        )
+    else:
+        print('Loading from CSV')
+        backlinks = read_export(backlinks_file)
+        domains = read_export(domains_file)
+
+        print('Cleaning and processing tables')
+        backlinks = transform_backlinks(backlinks,update_time)
+        domains = transform_domains(domains,update_time)
+
+        print('Uploading backlinks to postgres')
+        utils.update_pg_table(pg_engine,
+            backlinks,
+            'backlinks',
+            ['referring_page_url', 'link_url', 'first_seen'],
+            'all'
+        )
+        print('Uploading domains to postgres')
+        utils.update_pg_table(pg_engine,
+            domains,
+            'domains',
+            ['referring_domain'],
+            'all'
+        )
 
     print('Updating url/domain matches')
     update_domain_matches(pg_engine)
@@ -186,4 +241,4 @@ def upload_ahrefs_data(
     update_domains_to_scrape(pg_engine)
 
     print('------------------------------------')
-    print('Upload of new crawler data complete.')
\ No newline at end of file
+    print('Upload of new crawler data complete.')
@@ -1,11 +1,21 @@
-import io, re, json, base64
+import io, os, re, json, base64, threading, zlib
 import pandas as pd
 import psycopg2
+import psycopg2.extras
 import sqlalchemy as sql
 
 def clean_link_strings(link_string):
     return link_string.replace("\\","\\\\").replace('"','\"')
 
+def clean_copy_strings(df,columns=None):
+    # Postgres rejects NUL bytes in text, so one in scraped text would fail
+    # the whole COPY in frame_to_pg.
+    columns = columns if columns is not None else df.columns
+    for col in columns:
+        if df[col].dtype == object:
+            df[col] = df[col].apply(lambda x: x.replace('\x00','') if isinstance(x,str) else x)
+    return df
+
 def get_matching_domain(url, all_domains):
     try:
         while '.' in url:
@@ -17,6 +27,81 @@ def get_matching_domain(url, all_domains):
     except Exception as e:
         return None, e
 
+class DomainIndex:
+    # Registered domains with the lookups scrape and upload need. Built once
+    # and reused between batches (see get_domain_index) rather than reread
+    # from the domains table for every batch. match gives the same answer as
+    # get_matching_domain; match_many takes a whole array of hostnames.
+    #
+    # Domains are kept in one set per label depth ('bbc.co.uk' is 3). A host
+    # is cut down to each depth some domain has, deepest (most specific)
+    # first, and only looked up in that depth's set, so deep hostnames skip
+    # the levels no domain has. match_many matches each distinct host once.
+    def __init__(self,domains=()):
+        self.domains = set(domain for domain in domains if isinstance(domain,str))
+        self.by_depth = {}
+        for domain in self.domains:
+            self.by_depth.setdefault(domain.count('.')+1,set()).add(domain)
+        self.set_levels()
+
+    def set_levels(self):
+        # get_matching_domain never checks a suffix without a dot, so depth 1
+        # domains can't match
+        self.levels = [(depth, self.by_depth[depth]) for depth in sorted(self.by_depth,reverse=True) if depth > 1]
+
+    def add(self,domain):
+        if isinstance(domain,str):
+            self.domains.add(domain)
+            depth = domain.count('.')+1
+            if depth not in self.by_depth:
+                self.by_depth[depth] = set()
+                self.set_levels()
+            self.by_depth[depth].add(domain)
+
+    def __len__(self):
+        return len(self.domains)
+
+    def __contains__(self,domain):
+        return domain in self.domains
+
+    def match_host(self,host):
+        n_labels = host.count('.')+1
+        for depth, level in self.levels:
+            while n_labels > depth:
+                host = host[host.find('.')+1:]
+                n_labels -= 1
+            if n_labels == depth and host in level:
+                return host
+        return None
+
+    def match(self,url):
+        if isinstance(url,str):
+            return self.match_host(url), None
+        return get_matching_domain(url,self.domains)
+
+    def match_many(self,urls):
+        # (match, error) pairs like get_matching_domain's for an array of
+        # hostnames; anything that isn't a string gets its error
+        urls = list(urls)
+        codes, hosts = pd.factorize(pd.Series(urls,dtype=object))
+        match_host = self.match_host
+        pairs = [(match_host(host), None) if isinstance(host,str) else get_matching_domain(host,self.domains)
+                 for host in hosts]
+        return [pairs[code] if code >= 0 else get_matching_domain(url,self.domains)
+                for code, url in zip(codes.tolist(),urls)]
+
+_domain_indexes = {}
+
+def get_domain_index(pg_engine,refresh=False):
+    # DomainIndex over the domains table, kept between calls and rebuilt only
+    # when the table has changed
+    version_df = frame_from_pg("""SELECT COUNT(*) AS n, MAX(last_updated) AS last_updated FROM domains""",pg_engine)
+    version = tuple(version_df.iloc[0])
+    key = str(pg_engine.url)
+    if refresh or key not in _domain_indexes or _domain_indexes[key][0] != version:
+        _domain_indexes[key] = (version, DomainIndex(get_all_ahrefs_domains(pg_engine)))
+    return _domain_indexes[key][1]
+
 def get_url_main(url):
     try:
         url_split = re.search('^(https?://)(www.)?([^/]*)\/?(.*)',url)
@@ -26,9 +111,12 @@ def get_url_main(url):
     return url_main
 
 def get_all_ahrefs_domains(pg_engine):
-    all_ahrefs_domains_df = utils.frame_from_pg("""SELECT referring_domain FROM domains""",pg_engine)
+    all_ahrefs_domains_df = frame_from_pg("""SELECT referring_domain FROM domains""",pg_engine)
     return set(all_ahrefs_domains_df['referring_domain'])
 
+SPLIT_URL_PATTERN = re.compile('(https?://)(wwww?\d?.)?([^/?]*)\/?([^?]*)\??(.*)')
+SPLIT_URL_COLUMNS = ['url_https','url_www','url_main','url_path','url_params','error_in_split_url']
+
 def split_url(url):
     try:
         if url.startswith('\"'):
@@ -36,7 +124,7 @@ def split_url(url):
             if url.endswith('\"'):
                 url = url[:-1]
         url = url.strip()
-        url_split = re.search('(https?://)(wwww?\d?.)?([^/?]*)\/?([^?]*)\??(.*)',url)
+        url_split = SPLIT_URL_PATTERN.search(url)
         url_https = url_split.group(1).strip() if url_split.group(1) else None
         url_www = url_split.group(2).strip() if url_split.group(2) else None
         url_main = url_split.group(3).strip() if url_split.group(3) else None
@@ -44,64 +132,283 @@ def split_url(url):
         url_params = url_split.group(5).strip() if url_split.group(5) else None
         return url_https, url_www, url_main, url_path, url_params, None
     except Exception as e:
-        return None, None, None, None, None, e    
+        return None, None, None, None, None, e
+
+def split_urls(urls):
+    # split_url over a whole Series (or array) of urls at once, returning a
+    # frame of SPLIT_URL_COLUMNS with the same index and the same values and
+    # per row errors split_url gives. One tight loop over the values with the
+    # pattern compiled once; pandas' str.extract turned out slower than the
+    # apply it was meant to replace.
+    search = SPLIT_URL_PATTERN.search
+    rows = []
+    append = rows.append
+    for url in urls:
+        try:
+            if url.startswith('\"'):
+                url = url[1:]
+                if url.endswith('\"'):
+                    url = url[:-1]
+            url_https, url_www, url_main, url_path, url_params = search(url.strip()).group(1,2,3,4,5)
+            append((url_https.strip() if url_https else None,
+                    url_www.strip() if url_www else None,
+                    url_main.strip() if url_main else None,
+                    url_path.strip() if url_path else None,
+                    url_params.strip() if url_params else None,
+                    None))
+        except Exception as e:
+            append((None,None,None,None,None,e))
+    index = urls.index if isinstance(urls,pd.Series) else None
+    return pd.DataFrame(rows,index=index,columns=SPLIT_URL_COLUMNS)
 
 def decode_base64(text):
     text = base64.b64decode(text).decode('utf-8')
     return text
 
+# html and main are stored as zlib compressed bytea, link lists as jsonb.
+# Values can arrive as bytes (memoryview from a cursor), as postgres hex
+# strings ('\\x...', from frame_from_pg's CSV COPY) or, for rows scraped
+# before migrate_scraped_domains_storage, as the old base64 text.
+
+def encode_bytea(data):
+    # zlib compressed, written as a hex literal postgres casts to bytea
+    if data is None:
+        return None
+    if isinstance(data,str):
+        data = data.encode('utf-8')
+    return '\\x' + zlib.compress(data).hex()
+
+def decode_bytes(value):
+    if value is None or (isinstance(value,float) and value != value):
+        return None
+    if isinstance(value,str):
+        if value.startswith('\\x'):
+            value = bytes.fromhex(value[2:])
+        else:
+            return base64.b64decode(value)
+    return zlib.decompress(bytes(value))
+
+def decode_text(value):
+    data = decode_bytes(value)
+    return data.decode('utf-8') if data is not None else None
+
+def encode_link_list(links):
+    return json.dumps(links)
+
+def decode_link_list(value):
+    if value is None or isinstance(value,list):
+        return value
+    if isinstance(value,float) and value != value:
+        return None
+    if not value.startswith('['):
+        value = decode_base64(value)
+    return json.loads(value)
+
 def decode_links(row):
     for col in ['links','links_main_domains','links_ahrefs_domains']:
-        row[col] = json.loads(decode_base64(row[col]))
+        row[col] = decode_link_list(row[col])
     return row
 
+def get_column_types(engine,table_name):
+    conn = engine.raw_connection()
+    cur = conn.cursor()
+    cur.execute("""SELECT a.attname, format_type(a.atttypid, a.atttypmod)
+                     FROM pg_attribute AS a
+                    WHERE a.attrelid = %s::regclass AND a.attnum > 0 AND NOT a.attisdropped""",
+                (table_name,))
+    column_types = dict(cur.fetchall())
+    conn.close()
+    return column_types
+
 def frame_to_pg(engine,df,table_name, primary_keys):    
     df.head(0).to_sql(table_name, engine, if_exists='replace',index=False)
     
     conn = engine.raw_connection()
     cur = conn.cursor()
-    output = io.StringIO()
-    df.to_csv(output, sep='\t', encoding='utf-8', header=False, index=False)
-    output.seek(0)
-    cur.copy_from(output, table_name, null="") # null values become ''
+    copy_chunk(cur,df,table_name)
     cur.execute("""ALTER TABLE {} ADD PRIMARY KEY ({});""".format(table_name,", ".join(primary_keys)))
     conn.commit()
     conn.close()
 
-def update_pg_table(engine,df,table_name,primary_keys,update_cols=None):
-    frame_to_pg(engine,df,table_name+'_temp', primary_keys)
-
+def add_columns(engine,table_name,columns):
     conn = engine.connect()
+    for col, col_type in columns.items():
+        conn.execute("""ALTER TABLE {} ADD COLUMN IF NOT EXISTS {} {};""".format(table_name,col,col_type))
+    conn.close()
+
+def cast_column(col,col_type):
+    # Staging values are the text pandas wrote, where an integer column with
+    # missing values comes out as floats ('12.0'), so integers go via numeric
+    if col_type in ('bigint','integer','smallint'):
+        return '{}::numeric::{}'.format(col,col_type)
+    return '{}::{}'.format(col,col_type)
+
+def merge_staging(cur,staging_name,table_name,columns,primary_keys,update_cols,column_types):
+    # Upserts the staging table into table_name in one statement, casting to
+    # the target's types (text to bytea/jsonb has no implicit assignment
+    # cast). Rows already in table_name get update_cols overwritten, new rows
+    # are inserted whole.
     if update_cols == 'all':
-        update_cols = [x for x in df.columns]
+        update_cols = [x for x in columns]
     if update_cols:
         if not isinstance(update_cols,list):
             print("Error: update_cols must be a list of columns, None, or 'all'")
             return
         update_cols = [x for x in update_cols if x not in primary_keys]
-        col_string = ', '.join(['{} = t2.{}'.format(x,x) for x in update_cols])
-        key_string = ' AND '.join(['t.{} = t2.{}'.format(x,x) for x in primary_keys])
+    if update_cols:
+        conflict_string = 'DO UPDATE SET {}'.format(
+            ', '.join(['{} = EXCLUDED.{}'.format(x,x) for x in update_cols]))
+    else:
+        conflict_string = 'DO NOTHING'
+    col_string = ', '.join([x for x in columns])
+    select_string = ', '.join([cast_column(x,column_types[x]) for x in columns])
+    cur.execute("""INSERT INTO {} ({}) SELECT {} FROM {} ON CONFLICT ({}) {};""".format(
+        table_name,col_string,select_string,staging_name,', '.join(primary_keys),conflict_string))
 
-        update_string = """UPDATE {} AS t SET {} FROM {}_temp AS t2 WHERE {}""".format(
-            table_name,col_string,table_name,key_string
-        )
-        conn.execute(update_string)
-    all_cols = [x for x in df.columns]
-    col_string = ', '.join([x for x in all_cols])
-    conn.execute("""INSERT INTO {} ({}) SELECT {} FROM {}_temp ON CONFLICT DO NOTHING;""".format(
-                                                        table_name,col_string,col_string,table_name)
-                )
-    conn.execute("""DROP TABLE {}_temp;""".format(table_name))
-    conn.close()    
-
-def frame_from_pg(query, engine):
-    copy_sql = "COPY ({query}) TO STDOUT WITH CSV {head}".format(
-       query=query, head="HEADER"
-    )
+def copy_chunk(cur,df,table_name):
+    # CSV COPY reads back exactly what to_csv quotes; null values become ''
+    output = io.StringIO()
+    df.to_csv(output, sep='\t', encoding='utf-8', header=False, index=False)
+    output.seek(0)
+    cur.copy_expert("""COPY {} ({}) FROM STDIN WITH (FORMAT csv, DELIMITER E'\\t', NULL '')""".format(
+        table_name,', '.join(df.columns)), output)
+
+def stream_update_pg_table(engine,chunks,table_name,primary_keys,update_cols=None,verbose=True):
+    # Writes frames into table_name through a TEMP staging table, which
+    # belongs to this session only (so concurrent writers can't collide) and
+    # is dropped on commit. chunks is any iterable of frames with the same
+    # columns, e.g. a read_csv chunksize reader, each copied into the
+    # all-text staging table as it arrives so only one is in memory at a
+    # time. The staging table is then upserted in the same transaction, see
+    # merge_staging.
+    column_types = get_column_types(engine,table_name)
+    staging_name = table_name+'_staging'
     conn = engine.raw_connection()
     cur = conn.cursor()
-    store = io.StringIO()
-    cur.copy_expert(copy_sql, store)
-    store.seek(0)
-    df = pd.read_csv(store)
-    return df
\ No newline at end of file
+    columns = None
+    rows = 0
+    try:
+        for chunk in chunks:
+            if columns is None:
+                columns = list(chunk.columns)
+                cur.execute("""CREATE TEMP TABLE {} ({}) ON COMMIT DROP""".format(
+                    staging_name,', '.join(['{} TEXT'.format(x) for x in columns])))
+            copy_chunk(cur,chunk[columns],staging_name)
+            rows += chunk.shape[0]
+            if verbose:
+                print('Copied {} rows to {}'.format(rows,staging_name))
+        if columns is not None:
+            merge_staging(cur,staging_name,table_name,columns,primary_keys,update_cols,column_types)
+        conn.commit()
+    finally:
+        conn.close()
+    return rows
+
+def update_pg_table(engine,df,table_name,primary_keys,update_cols=None):
+    return stream_update_pg_table(engine,[df],table_name,primary_keys,update_cols,verbose=False)
+
+def migrate_scraped_domains_storage(pg_engine,chunk_size=1000):
+    # One-off conversion of scraped_domains from base64 text columns to
+    # compressed bytea (html, main) and jsonb (link lists). Link lists are
+    # converted in SQL, html/main are recompressed here in chunks. Runs in one
+    # transaction, and does nothing on an already migrated table.
+    column_types = get_column_types(pg_engine,'scraped_domains')
+    conn = pg_engine.raw_connection()
+    cur = conn.cursor()
+    for col in ['links','links_main_domains','links_ahrefs_domains']:
+        if column_types.get(col) == 'text':
+            print('Converting {} to jsonb'.format(col))
+            cur.execute("""ALTER TABLE scraped_domains ALTER COLUMN {col} TYPE jsonb
+                           USING CASE WHEN left({col},1) = '[' THEN {col}::jsonb
+                                      ELSE convert_from(decode({col},'base64'),'UTF8')::jsonb END""".format(col=col))
+    text_cols = [col for col in ['html','main'] if column_types.get(col) == 'text']
+    if text_cols:
+        print('Compressing {}'.format(', '.join(text_cols)))
+        for col in text_cols:
+            cur.execute("""ALTER TABLE scraped_domains ADD COLUMN {}_z bytea""".format(col))
+        reader = conn.cursor('scraped_domains_storage_migration')
+        reader.itersize = chunk_size
+        reader.execute("""SELECT domain, {} FROM scraped_domains""".format(', '.join(text_cols)))
+        converted = 0
+        while True:
+            rows = reader.fetchmany(chunk_size)
+            if not rows:
+                break
+            values = [[row[0]] + [psycopg2.Binary(zlib.compress(decode_bytes(x))) if x is not None else None
+                                  for x in row[1:]] for row in rows]
+            psycopg2.extras.execute_values(cur,
+                """UPDATE scraped_domains AS t SET {} FROM (VALUES %s) AS v (domain, {})
+                    WHERE t.domain = v.domain""".format(
+                    ', '.join(['{}_z = v.{}::bytea'.format(col,col) for col in text_cols]),
+                    ', '.join(text_cols)),
+                values)
+            converted += len(rows)
+            print('Compressed {} rows'.format(converted))
+        reader.close()
+        for col in text_cols:
+            cur.execute("""ALTER TABLE scraped_domains DROP COLUMN {}""".format(col))
+            cur.execute("""ALTER TABLE scraped_domains RENAME COLUMN {}_z TO {}""".format(col,col))
+    conn.commit()
+    conn.close()
+    print('scraped_domains storage migration complete')
+
+class PgCopyReader:
+    # Streams "COPY (query) TO STDOUT WITH CSV HEADER" through a pipe, with
+    # COPY running in a thread on one end and read_csv parsing the other, so
+    # the CSV text is never held in memory as a whole.
+    def __init__(self,query,engine):
+        self.copy_sql = "COPY ({query}) TO STDOUT WITH CSV {head}".format(
+           query=query, head="HEADER"
+        )
+        self.conn = engine.raw_connection()
+        read_fd, write_fd = os.pipe()
+        self.reader = os.fdopen(read_fd,'rb')
+        self.writer = os.fdopen(write_fd,'wb')
+        self.error = None
+        self.thread = threading.Thread(target=self.copy,daemon=True)
+        self.thread.start()
+
+    def copy(self):
+        try:
+            self.conn.cursor().copy_expert(self.copy_sql,self.writer)
+        except Exception as e:
+            self.error = e
+        finally:
+            try:
+                self.writer.close()
+            except OSError:
+                pass
+
+    def close(self):
+        # Closing the read end first lets a COPY still writing fail rather
+        # than block when the reader stopped early
+        self.reader.close()
+        self.thread.join()
+        self.conn.close()
+        if self.error is not None and not isinstance(self.error,BrokenPipeError):
+            raise self.error
+
+def read_pg_chunks(query,engine,chunksize,dtype=None,parse_dates=None):
+    copy_reader = PgCopyReader(query,engine)
+    try:
+        for chunk in pd.read_csv(copy_reader.reader,dtype=dtype,parse_dates=parse_dates,
+                                 chunksize=chunksize,encoding='utf-8'):
+            yield chunk
+    finally:
+        copy_reader.close()
+
+READ_CHUNKSIZE = 50000
+
+def frame_from_pg(query, engine, dtype=None, parse_dates=None, chunksize=None):
+    # Reads a query into a DataFrame through COPY. dtype and parse_dates are
+    # passed to read_csv, so callers can fix types rather than have them
+    # inferred (dates otherwise come back as strings). With chunksize, returns
+    # an iterator of frames of up to that many rows instead, for results too
+    # big to hold at once. Whole results are read in chunks too and
+    # concatenated, as read_csv in one go peaks at about twice the memory.
+    if chunksize:
+        return read_pg_chunks(query,engine,chunksize,dtype,parse_dates)
+    chunks = list(read_pg_chunks(query,engine,READ_CHUNKSIZE,dtype,parse_dates))
+    if len(chunks) == 1:
+        return chunks[0]
+    return pd.concat(chunks,ignore_index=True)
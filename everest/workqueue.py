@@ -0,0 +1,181 @@
+import os, socket, time, threading, uuid
+
+from everest import scrape, utils
+
+# Postgres backed work queue so several scrapers (on any number of machines)
+# can share a scrape without duplicating work. Workers claim batches of
+# domains with FOR UPDATE SKIP LOCKED and hold a lease on them, renewed by a
+# background thread while they work. A crashed worker's leases expire and its
+# domains are claimed again; domains that keep failing are given up on after
+# max_attempts claims.
+
+WORKER_MODES = ['sync','async']
+
+def create_queue(pg_engine):
+    conn = pg_engine.raw_connection()
+    cur = conn.cursor()
+    cur.execute("""CREATE TABLE IF NOT EXISTS scrape_queue (
+                       domain TEXT PRIMARY KEY,
+                       first_seen TIMESTAMPTZ,
+                       lease_owner TEXT,
+                       lease_expires TIMESTAMPTZ,
+                       attempts INTEGER NOT NULL DEFAULT 0,
+                       enqueued_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                       completed_at TIMESTAMPTZ
+                   );""")
+    cur.execute("""CREATE INDEX IF NOT EXISTS scrape_queue_pending
+                       ON scrape_queue (first_seen DESC) WHERE completed_at IS NULL;""")
+    conn.commit()
+    conn.close()
+
+def enqueue(pg_engine,scrape_condition='WHERE last_scrape_date IS NULL'):
+    # Adds matching domains to the queue. Domains already completed are put
+    # back, ones still pending or leased are left alone.
+    create_queue(pg_engine)
+    conn = pg_engine.raw_connection()
+    cur = conn.cursor()
+    cur.execute("""INSERT INTO scrape_queue (domain, first_seen)
+                   SELECT domain, first_seen::timestamptz FROM scraped_domains {}
+                   ON CONFLICT (domain) DO UPDATE
+                      SET completed_at = NULL, attempts = 0, lease_owner = NULL,
+                          lease_expires = NULL, enqueued_at = now()
+                    WHERE scrape_queue.completed_at IS NOT NULL;""".format(scrape_condition))
+    enqueued = cur.rowcount
+    conn.commit()
+    conn.close()
+    print('Enqueued {} domains'.format(enqueued))
+    return enqueued
+
+def claim(conn,worker_id,batch_size,lease_seconds,max_attempts):
+    cur = conn.cursor()
+    cur.execute("""WITH claimable AS (
+                        SELECT domain
+                          FROM scrape_queue
+                         WHERE completed_at IS NULL
+                               AND (lease_expires IS NULL OR lease_expires < now())
+                               AND attempts < %s
+                      ORDER BY first_seen DESC
+                         LIMIT %s
+                           FOR UPDATE SKIP LOCKED
+                   )
+                   UPDATE scrape_queue AS q
+                      SET lease_owner = %s,
+                          lease_expires = now() + %s * interval '1 second',
+                          attempts = q.attempts + 1
+                     FROM claimable
+                    WHERE q.domain = claimable.domain
+                RETURNING q.domain;""",
+                (max_attempts,batch_size,worker_id,lease_seconds))
+    domains = [row[0] for row in cur.fetchall()]
+    conn.commit()
+    return domains
+
+def renew(conn,worker_id,lease_seconds):
+    cur = conn.cursor()
+    cur.execute("""UPDATE scrape_queue
+                      SET lease_expires = now() + %s * interval '1 second'
+                    WHERE lease_owner = %s AND completed_at IS NULL;""",
+                (lease_seconds,worker_id))
+    conn.commit()
+
+def complete(conn,worker_id,domains):
+    cur = conn.cursor()
+    cur.execute("""UPDATE scrape_queue
+                      SET completed_at = now(), lease_owner = NULL, lease_expires = NULL
+                    WHERE domain = ANY(%s) AND lease_owner = %s;""",
+                (list(domains),worker_id))
+    conn.commit()
+
+def release(conn,worker_id):
+    # Hands back whatever this worker still holds so others can claim it now
+    cur = conn.cursor()
+    cur.execute("""UPDATE scrape_queue
+                      SET lease_owner = NULL, lease_expires = NULL
+                    WHERE lease_owner = %s AND completed_at IS NULL;""",
+                (worker_id,))
+    conn.commit()
+
+def queue_status(pg_engine,max_attempts=3):
+    return utils.frame_from_pg("""SELECT CASE WHEN completed_at IS NOT NULL THEN 'completed'
+                                              WHEN lease_expires > now() THEN 'leased'
+                                              WHEN attempts >= {} THEN 'failed'
+                                              ELSE 'pending' END AS status,
+                                         COUNT(*) AS domains
+                                    FROM scrape_queue
+                                GROUP BY 1""".format(int(max_attempts)),pg_engine)
+
+class LeaseKeeper(threading.Thread):
+    def __init__(self,pg_engine,worker_id,lease_seconds):
+        threading.Thread.__init__(self,daemon=True)
+        self.conn = pg_engine.raw_connection()
+        self.worker_id = worker_id
+        self.lease_seconds = lease_seconds
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.lease_seconds/3):
+            try:
+                renew(self.conn,self.worker_id,self.lease_seconds)
+            except Exception as e:
+                print('Lease renewal failed for {}: {}'.format(self.worker_id,e))
+                self.conn.rollback()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.conn.close()
+
+def run_worker(pg_engine,worker_id=None,batch_size=100,lease_seconds=300,max_attempts=3,
+               time_limit=2,mode='sync',concurrency=100,per_host=2,race=False,
+               wait_for_work=False,poll_interval=10,scraper=None):
+    # Claims, scrapes and uploads batches until the queue is empty (or, with
+    # wait_for_work, forever). Safe to run any number of these at once.
+    # A scraper passed in (anything with scrape_frame) is used in place of
+    # the one mode would make, and left open.
+    if mode not in WORKER_MODES:
+        raise ValueError("worker mode must be 'sync' or 'async'.")
+    worker_id = worker_id or '{}-{}-{}'.format(socket.gethostname(),os.getpid(),uuid.uuid4().hex[:8])
+    create_queue(pg_engine)
+    all_ahrefs_domains = utils.get_domain_index(pg_engine)
+    utils.add_columns(pg_engine,'scraped_domains',{'last_scrape_url': 'TEXT'})
+
+    own_scraper = scraper is None and mode == 'async'
+    if own_scraper:
+        from everest import async_scrape
+        scraper = async_scrape.AsyncScraper(time_limit,concurrency,per_host,race=race)
+
+    conn = pg_engine.raw_connection()
+    keeper = LeaseKeeper(pg_engine,worker_id,lease_seconds)
+    keeper.start()
+    start = time.time()
+    completed = 0
+    try:
+        while True:
+            domains = claim(conn,worker_id,batch_size,lease_seconds,max_attempts)
+            if not domains:
+                if wait_for_work:
+                    time.sleep(poll_interval)
+                    continue
+                break
+            sql_query = conn.cursor().mogrify(
+                """SELECT * FROM scraped_domains WHERE domain = ANY(%s)""",(domains,)).decode('utf-8')
+            immediate = utils.frame_from_pg(sql_query,pg_engine)
+            if immediate.shape[0] > 0:
+                if scraper:
+                    immediate = scraper.scrape_frame(immediate,all_ahrefs_domains)
+                else:
+                    immediate = immediate.apply(scrape.scrape_domain,axis=1,args=(all_ahrefs_domains,time_limit,))
+                scrape.upload_scraped_bisect(pg_engine,immediate)
+            complete(conn,worker_id,domains)
+            completed += len(domains)
+            print('Worker {} scraped {} domains. Elapsed time: {}'.format(
+                worker_id,completed,time.time()-start))
+    finally:
+        keeper.stop()
+        try:
+            release(conn,worker_id)
+        finally:
+            conn.close()
+            if own_scraper:
+                scraper.close()
+    return completed